@@ -2,13 +2,29 @@ import os
 import io
 import json
 import re
+import zlib
+import time
+import random
+import signal
+import base64
+import codecs
+import hashlib
 import secrets
+import tempfile
+import asyncio
+import threading
+import unicodedata
 import httpx
-import redis
+import numpy as np
+import redis.asyncio as redis
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from fastapi import FastAPI, Request, Depends, HTTPException, Form, UploadFile, File
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 from datetime import datetime, timedelta
 
 # ============================================================
@@ -23,25 +39,230 @@ ADMIN_USER        = os.environ.get("ADMIN_USER", "admin")
 ADMIN_PASS        = os.environ.get("ADMIN_PASS", "admin123")
 BASE_URL          = os.environ.get("BASE_URL", "https://SEU-DOMINIO.up.railway.app")
 AGENT_NAME        = os.environ.get("AGENT_NAME", "PrimeiraMente")
-AGENT_MODEL       = os.environ.get("AGENT_MODEL", "claude-haiku-4-5-20251001")
+AGENT_MODEL       = os.environ.get("AGENT_MODEL", "claude-haiku-4-5-20251001")  # modelo padrao e reserva do roteador
+AGENT_MODEL_PREMIUM  = os.environ.get("AGENT_MODEL_PREMIUM", "") or AGENT_MODEL   # usuarios Premium
+AGENT_MODEL_COMPLEXO = os.environ.get("AGENT_MODEL_COMPLEXO", "") or AGENT_MODEL  # mensagens longas e PDFs/planilhas
 GROQ_API_KEY      = os.environ.get("GROQ_API_KEY")
 MP_ACCESS_TOKEN   = os.environ.get("MP_ACCESS_TOKEN")
 MP_PUBLIC_KEY     = os.environ.get("MP_PUBLIC_KEY")
 MP_PLAN_ID        = os.environ.get("MP_PLAN_ID", "bc34d81de9ba466b8d2693d1a134871c")
 LINK_PAGAMENTO    = os.environ.get("LINK_PAGAMENTO", "")  # link externo opcional
+REDIS_CONEXOES    = int(os.environ.get("REDIS_CONEXOES", "50"))     # tamanho do pool de conexoes
+REDIS_TIMEOUT     = float(os.environ.get("REDIS_TIMEOUT", "5"))     # segundos por comando/espera por conexao
+HTTP_CONEXOES     = int(os.environ.get("HTTP_CONEXOES", "20"))      # conexoes por servico externo
+MIDIA_MAX_MB      = float(os.environ.get("MIDIA_MAX_MB", "15"))     # limite de download de audio/PDF/planilha
+ARQUIVO_MAX_KB    = int(os.environ.get("ARQUIVO_MAX_KB", "20480"))  # limite de upload no painel (PDF/TXT de referencia)
+EXTRACAO_PROCESSOS = int(os.environ.get("EXTRACAO_PROCESSOS", "2")) # processos para ler PDF/planilha
+EXTRACAO_TIMEOUT  = float(os.environ.get("EXTRACAO_TIMEOUT", "30")) # segundos por arquivo
+ARQUIVO_INTEGRAL_CHARS = int(os.environ.get("ARQUIVO_INTEGRAL_CHARS", "4000"))  # arquivos ate esse tamanho vao inteiros no prompt
+BUSCA_TRECHOS     = int(os.environ.get("BUSCA_TRECHOS", "4"))       # trechos dos arquivos grandes enviados por mensagem
+MIDIA_CACHE_MB    = float(os.environ.get("MIDIA_CACHE_MB", "100"))  # espaco maximo do cache de transcricoes/leituras
+MIDIA_CACHE_DIAS  = float(os.environ.get("MIDIA_CACHE_DIAS", "7"))  # sem uso por esse tempo, a entrada expira
+FILA_WORKERS      = int(os.environ.get("FILA_WORKERS", "4"))        # mensagens processadas em paralelo
+FILA_TAMANHO      = int(os.environ.get("FILA_TAMANHO", "500"))      # limite de mensagens aguardando
+FILA_TENTATIVAS   = int(os.environ.get("FILA_TENTATIVAS", "3"))     # antes de ir para a lista de falhas
+FILA_BACKOFF      = float(os.environ.get("FILA_BACKOFF", "2"))      # segundos, dobra a cada tentativa
+AGRUPAR_SEGUNDOS  = float(os.environ.get("AGRUPAR_SEGUNDOS", "3"))  # janela para juntar mensagens seguidas
+LLM_CONCORRENCIA  = int(os.environ.get("LLM_CONCORRENCIA", "8"))    # chamadas simultaneas ao Claude
+LLM_RPM           = float(os.environ.get("LLM_RPM", "50"))          # requisicoes/minuto por modelo (0 = sem limite)
+LLM_RPM_MODELOS   = os.environ.get("LLM_RPM_MODELOS", "")           # ex: "claude-sonnet-4-5=20,claude-haiku-4-5=50"
+LLM_SLO_P95       = float(os.environ.get("LLM_SLO_P95", "20"))      # segundos; acima disso o roteador volta para o AGENT_MODEL (0 = desliga)
+ROTEADOR_COMPLEXO_CHARS = int(os.environ.get("ROTEADOR_COMPLEXO_CHARS", "600"))  # mensagem a partir desse tamanho vai para o modelo de mensagens complexas
+CONTEXTO_TOKENS   = int(os.environ.get("CONTEXTO_TOKENS", "6000"))  # tokens de historico enviados ao Claude por turno
+RESUMO_MODELO     = os.environ.get("RESUMO_MODELO", "claude-haiku-4-5-20251001")  # modelo barato que resume a conversa antiga
+ASSINATURAS_VARRER = float(os.environ.get("ASSINATURAS_VARRER", "300"))  # segundos entre buscas por assinaturas vencidas
+AVISO_RENOVACAO   = os.environ.get("AVISO_RENOVACAO", "0") == "1"   # avisa no WhatsApp quando a assinatura vence
+WEBHOOK_DEDUP_HORAS = float(os.environ.get("WEBHOOK_DEDUP_HORAS", "24"))  # por quanto tempo um id de mensagem/notificacao e lembrado
+MP_AGRUPAR_SEGUNDOS = float(os.environ.get("MP_AGRUPAR_SEGUNDOS", "10"))  # notificacoes repetidas do mesmo id viram uma consulta so
+MP_CACHE_SEGUNDOS = int(os.environ.get("MP_CACHE_SEGUNDOS", "30"))  # reaproveita a resposta do MP por esse tempo
+MP_TENTATIVAS     = int(os.environ.get("MP_TENTATIVAS", "5"))       # consultas ao MP antes de desistir de um id
+MP_SINCRONIZAR_HORA = int(os.environ.get("MP_SINCRONIZAR_HORA", "3"))  # hora da sincronizacao diaria com o MP (-1 desliga)
+ENVIO_WORKERS     = int(os.environ.get("ENVIO_WORKERS", "2"))       # filas de envio para o WhatsApp (cada telefone cai sempre na mesma)
+ENVIO_RPM         = float(os.environ.get("ENVIO_RPM", "60"))        # mensagens/minuto enviadas a Z-API (0 = sem limite)
+ENVIO_TENTATIVAS  = int(os.environ.get("ENVIO_TENTATIVAS", "4"))    # tentativas por mensagem antes de marcar como falha
+ENVIO_STATUS_HORAS = float(os.environ.get("ENVIO_STATUS_HORAS", "24"))  # por quanto tempo o status de cada envio fica guardado
+ENVIO_EM_PARTES   = os.environ.get("ENVIO_EM_PARTES", "1") == "1"  # manda a resposta em partes enquanto o Claude ainda escreve
+ENVIO_PARTE_MIN   = int(os.environ.get("ENVIO_PARTE_MIN", "120"))   # depois da primeira, so corta em fim de frase a partir desse tamanho
+RESPOSTAS_CACHE    = os.environ.get("RESPOSTAS_CACHE", "0") == "1"  # reaproveita respostas a perguntas iguais feitas sem contexto
+RESPOSTAS_CACHE_HORAS = float(os.environ.get("RESPOSTAS_CACHE_HORAS", "24"))  # validade de cada resposta guardada
+RESPOSTAS_CACHE_MAX = int(os.environ.get("RESPOSTAS_CACHE_MAX", "1000"))  # respostas guardadas; passando disso saem as usadas ha mais tempo
+CONTADORES_RECONCILIAR = float(os.environ.get("CONTADORES_RECONCILIAR", "3600"))  # segundos entre conferencias dos contadores do painel
 
 AGENT_PROMPT_PADRAO = """Voce e um assistente prestativo e simpatico.
 Responda de forma clara, direta e em portugues.
 No WhatsApp, seja breve — uma ideia por mensagem, no maximo."""
 
-client   = Anthropic(api_key=ANTHROPIC_API_KEY)
-app      = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global processos_extracao
+    abrir_clientes_http()
+    processos_extracao = ProcessPoolExecutor(max_workers=EXTRACAO_PROCESSOS)
+    workers = [asyncio.create_task(worker_fila(i)) for i in range(FILA_WORKERS)]
+    workers += [asyncio.create_task(worker_envio(fila)) for fila in filas_envio]
+    await retomar_envios()
+    await retomar_mensagens()
+    workers.append(asyncio.create_task(reconciliar_contadores_periodicamente()))
+    workers.append(asyncio.create_task(varrer_assinaturas_periodicamente()))
+    workers.append(asyncio.create_task(reconciliador_mp()))
+    workers.append(asyncio.create_task(sincronizar_mp_diariamente()))
+    yield
+    # Janelas de agrupamento abertas fecham agora, para as mensagens entrarem no drain abaixo
+    for telefone in list(_janelas):
+        _janelas.pop(telefone).cancel()
+    for telefone in list(_pendentes):
+        await enfileirar_mensagens(telefone, _pendentes.pop(telefone))
+    # Da uma chance para as mensagens ja recebidas terminarem antes de desligar
+    try:
+        await asyncio.wait_for(fila_entrada.join(), timeout=10)
+    except asyncio.TimeoutError:
+        print(f"FILA: desligando com {fila_entrada.qsize()} mensagens pendentes")
+    try:
+        await asyncio.wait_for(asyncio.gather(*(fila.join() for fila in filas_envio)), timeout=10)
+    except asyncio.TimeoutError:
+        print(f"ENVIO: desligando com {sum(f.qsize() for f in filas_envio)} mensagens sem enviar")
+    # Os workers interrompidos guardam o que estavam processando/entregando; depois guarda o
+    # resto das filas e os jobs esperando nova tentativa
+    for w in workers:
+        w.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    if guardados := await guardar_envios_pendentes():
+        print(f"ENVIO: {guardados} mensagens guardadas para o proximo start")
+    if guardados := await guardar_jobs_pendentes():
+        print(f"FILA: {guardados} turnos guardados para o proximo start")
+    await fechar_clientes_http()
+    processos_extracao.shutdown(wait=False, cancel_futures=True)
+    await r.aclose()
+
+client   = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+app      = FastAPI(lifespan=lifespan)
 security = HTTPBasic()
 
 # ============================================================
 # REDIS
 # ============================================================
-r = redis.from_url(REDIS_URL, decode_responses=True)
+# Conta quantas idas ao Redis cada requisicao/turno faz (um pipeline conta como uma)
+_round_trips: ContextVar = ContextVar("round_trips_redis", default=None)
+
+def contar_round_trip():
+    contador = _round_trips.get()
+    if contador is not None:
+        contador[0] += 1
+
+@contextmanager
+def medir_round_trips():
+    contador = [0]
+    token = _round_trips.set(contador)
+    try:
+        yield contador
+    finally:
+        _round_trips.reset(token)
+
+class _ContaRoundTrips:
+    async def send_packed_command(self, command, check_health=True):
+        # check_health=False sao os PING/AUTH internos da conexao, nao comandos nossos
+        if check_health:
+            contar_round_trip()
+        return await super().send_packed_command(command, check_health)
+
+class ConexaoContada(_ContaRoundTrips, redis.Connection):
+    pass
+
+class ConexaoSSLContada(_ContaRoundTrips, redis.SSLConnection):
+    pass
+
+# Cliente assincrono com pool compartilhado: se todas as conexoes estiverem em uso,
+# espera ate REDIS_TIMEOUT por uma livre em vez de abrir conexoes sem limite
+redis_pool = redis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=REDIS_CONEXOES,
+    timeout=REDIS_TIMEOUT,
+    socket_timeout=REDIS_TIMEOUT,
+    socket_connect_timeout=REDIS_TIMEOUT,
+    socket_keepalive=True,
+    health_check_interval=30,
+    retry_on_timeout=True,
+    connection_class=ConexaoSSLContada if (REDIS_URL or "").startswith("rediss://") else ConexaoContada
+)
+r = redis.Redis(connection_pool=redis_pool)
+
+async def carregar_json(chaves: list) -> list:
+    """Le varias chaves JSON em um unico MGET, ignorando as que nao existem."""
+    if not chaves:
+        return []
+    return [json.loads(d) for d in await r.mget(chaves) if d]
+
+def timestamp_iso(data_iso: str | None) -> float:
+    try:
+        return datetime.fromisoformat(data_iso).timestamp() if data_iso else 0
+    except ValueError:
+        return 0
+
+# ============================================================
+# HTTP — um cliente por servico externo, aberto durante toda a vida do app
+# ============================================================
+# timeout padrao de cada servico; "midia" sao os downloads de audio/PDF/planilha do WhatsApp
+HTTP_SERVICOS = {
+    "zapi":        30,
+    "groq":        60,
+    "mercadopago": 30,
+    "midia":       60,
+}
+
+http_clientes: dict = {}
+metricas_http = {
+    nome: {"requisicoes": 0, "erros": 0, "latencias": deque(maxlen=500)}
+    for nome in HTTP_SERVICOS
+}
+
+def abrir_clientes_http():
+    limites = httpx.Limits(
+        max_connections=HTTP_CONEXOES,
+        max_keepalive_connections=HTTP_CONEXOES,
+        keepalive_expiry=60
+    )
+    for nome, timeout in HTTP_SERVICOS.items():
+        # http2 so e usado quando o servidor anuncia suporte; senao cai para HTTP/1.1
+        http_clientes[nome] = httpx.AsyncClient(timeout=timeout, limits=limites, http2=True)
+
+async def fechar_clientes_http():
+    for http in http_clientes.values():
+        await http.aclose()
+    http_clientes.clear()
+
+@contextmanager
+def medir_servico(servico: str):
+    metrica = metricas_http[servico]
+    inicio = time.monotonic()
+    try:
+        yield metrica
+    except Exception:
+        metrica["erros"] += 1
+        raise
+    finally:
+        metrica["requisicoes"] += 1
+        metrica["latencias"].append(time.monotonic() - inicio)
+
+async def requisitar(servico: str, metodo: str, url: str, **kwargs) -> httpx.Response:
+    """Faz a requisicao pelo cliente compartilhado do servico, registrando latencia e erros."""
+    with medir_servico(servico) as metrica:
+        resposta = await http_clientes[servico].request(metodo, url, **kwargs)
+        if resposta.status_code >= 400:
+            metrica["erros"] += 1
+        return resposta
+
+def percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))] if ordenados else 0
+
+def resumo_metricas_http() -> list:
+    return [{
+        "servico": nome,
+        "requisicoes": metrica["requisicoes"],
+        "erros": metrica["erros"],
+        "p50": percentil(metrica["latencias"], 0.50),
+        "p95": percentil(metrica["latencias"], 0.95),
+    } for nome, metrica in metricas_http.items()]
 
 # ============================================================
 # AUTENTICACAO ADMIN
@@ -60,63 +281,342 @@ def verificar_admin(credentials: HTTPBasicCredentials = Depends(security)):
 # ============================================================
 # PROMPT — salvo no Redis, editavel pelo painel
 # ============================================================
-PROMPT_KEY = "config:agent_prompt"
+PROMPT_KEY        = "config:agent_prompt"
+PROMPT_VERSAO_KEY = "config:prompt_versao"  # incrementada sempre que o prompt ou um arquivo muda
 
-def obter_prompt() -> str:
-    prompt = r.get(PROMPT_KEY)
+async def obter_prompt() -> str:
+    prompt = await r.get(PROMPT_KEY)
     return prompt if prompt else AGENT_PROMPT_PADRAO
 
-def salvar_prompt(prompt: str):
-    r.set(PROMPT_KEY, prompt)
+async def salvar_prompt(prompt: str):
+    pipe = r.pipeline()
+    pipe.set(PROMPT_KEY, prompt)
+    pipe.incr(PROMPT_VERSAO_KEY)
+    await pipe.execute()
+
+# Prompt com os arquivos ja injetados e o indice de busca dos arquivos grandes,
+# guardados em memoria ate a versao mudar
+_prompt_compilado = {"versao": None, "texto": "", "indice": None}
+_prompt_trava     = asyncio.Lock()  # uma recompilacao por vez; quem chega no meio espera e usa a dela
+
+async def obter_prompt_compilado(versao: str | None) -> str:
+    """`versao` deve ser lida do Redis antes do prompt: assim, se o admin salvar no meio
+    da montagem, a proxima mensagem ve a versao nova e monta de novo."""
+    versao = versao or "0"
+    if versao != _prompt_compilado["versao"]:
+        async with _prompt_trava:
+            if versao != _prompt_compilado["versao"]:
+                texto, grandes = await injetar_arquivos_no_prompt(await obter_prompt())
+                indice = await montar_indice_arquivos(grandes) if grandes else None
+                _prompt_compilado.update(versao=versao, texto=texto, indice=indice)
+                print(f"PROMPT recompilado (versao {versao}, {len(indice.trechos) if indice else 0} trechos indexados)")
+    return _prompt_compilado["texto"]
+
+def trechos_relevantes(consulta: str) -> str:
+    """Trechos dos arquivos grandes que mais combinam com a mensagem, ja formatados para o
+    prompt. Usa o indice da ultima compilacao, entao chame logo apos obter_prompt_compilado."""
+    indice = _prompt_compilado["indice"]
+    if not indice:
+        return ""
+    return "".join(f"\n\n=== TRECHO DE '{nome}' ===\n{texto}" for nome, texto in indice.buscar(consulta[:2000], BUSCA_TRECHOS))
 
 # ============================================================
 # ARQUIVOS DE REFERENCIA
 # ============================================================
-ARQUIVO_PREFIX = "config:arquivo:"
-
-def listar_arquivos() -> list:
-    chaves = r.keys(f"{ARQUIVO_PREFIX}*")
-    arquivos = []
-    for chave in sorted(chaves):
-        nome = chave.replace(ARQUIVO_PREFIX, "")
-        tamanho = len(r.get(chave) or "")
-        arquivos.append({"nome": nome, "tamanho": tamanho})
-    return arquivos
-
-def obter_arquivo(nome: str) -> str | None:
-    return r.get(f"{ARQUIVO_PREFIX}{nome}")
-
-def salvar_arquivo(nome: str, conteudo: str):
-    r.set(f"{ARQUIVO_PREFIX}{nome}", conteudo[:20000])
-
-def apagar_arquivo(nome: str):
-    r.delete(f"{ARQUIVO_PREFIX}{nome}")
-
-def injetar_arquivos_no_prompt(prompt: str) -> str:
-    referencias = re.findall(r'\[([a-zA-Z0-9_\-]+)\]', prompt)
+ARQUIVO_PREFIX   = "config:arquivo:"            # formato antigo (texto inteiro); o reindexar converte
+MANIFESTO_PREFIX = "config:arquivo_manifesto:"  # hash: status, caracteres, trechos, paginas_lidas, paginas_total, erro, sinal
+TRECHOS_PREFIX   = "config:arquivo_trechos:"    # lista com os trechos do arquivo, comprimidos
+IDX_ARQUIVOS     = "idx:arquivos"  # set com os nomes dos arquivos
+ARQUIVO_PAGINAS_LOTE = 10          # paginas de PDF lidas por vez no upload
+# A leitura renova o "sinal" do manifesto a cada lote; sem sinal por esse tempo, ela morreu
+# junto com o processo (restart/deploy) e o arquivo e marcado com erro
+ARQUIVO_LEITURA_PARADA = max(120, 3 * EXTRACAO_TIMEOUT)
+
+# zlib + base64, porque o cliente Redis devolve tudo como texto (decode_responses)
+def comprimir(texto: str) -> str:
+    return base64.b64encode(zlib.compress(texto.encode())).decode()
+
+def descomprimir(dado: str) -> str:
+    return zlib.decompress(base64.b64decode(dado)).decode()
+
+async def listar_arquivos() -> list:
+    nomes = sorted(await r.smembers(IDX_ARQUIVOS))
+    pipe = r.pipeline(transaction=False)
+    for nome in nomes:
+        pipe.hgetall(f"{MANIFESTO_PREFIX}{nome}")
+    manifestos = await pipe.execute() if nomes else []
+    parados = [nome for nome, manifesto in zip(nomes, manifestos) if manifesto.get("status") == "processando"
+               and float(manifesto.get("sinal") or 0) < time.time() - ARQUIVO_LEITURA_PARADA]
+    for nome in parados:
+        erro = "leitura interrompida (o servidor reiniciou?) — envie o arquivo de novo"
+        await GravadorDeArquivo(nome).falhar(erro)
+        manifestos[nomes.index(nome)].update(status="erro", erro=erro)
+        print(f"ARQUIVO {nome}: leitura parada marcada como erro")
+    return [{"nome": nome, **manifesto} for nome, manifesto in zip(nomes, manifestos)]
+
+async def obter_arquivo(nome: str) -> str | None:
+    trechos = await r.lrange(f"{TRECHOS_PREFIX}{nome}", 0, -1)
+    return "\n\n".join(descomprimir(t) for t in trechos) if trechos else None
+
+async def apagar_arquivo(nome: str):
+    pipe = r.pipeline()
+    pipe.delete(f"{MANIFESTO_PREFIX}{nome}", f"{TRECHOS_PREFIX}{nome}", f"{TRECHOS_PREFIX}{nome}:novo")
+    pipe.srem(IDX_ARQUIVOS, nome)
+    pipe.incr(PROMPT_VERSAO_KEY)
+    await pipe.execute()
+
+
+class GravadorDeArquivo:
+    """Recebe o texto aos poucos, divide em trechos e grava comprimido numa lista temporaria.
+    So o bloco atual fica em memoria. A versao anterior continua valendo ate concluir(),
+    que troca as duas de uma vez."""
+
+    def __init__(self, nome: str):
+        self.nome      = nome
+        self.manifesto = f"{MANIFESTO_PREFIX}{nome}"
+        self.final     = f"{TRECHOS_PREFIX}{nome}"
+        self.novo      = f"{TRECHOS_PREFIX}{nome}:novo"
+
+    async def iniciar(self):
+        self.buffer, self.caracteres, self.trechos = "", 0, 0
+        pipe = r.pipeline()
+        pipe.delete(self.novo)
+        pipe.hset(self.manifesto, mapping={"status": "processando", "paginas_lidas": 0, "paginas_total": 0, "sinal": time.time()})
+        pipe.hdel(self.manifesto, "erro")
+        pipe.sadd(IDX_ARQUIVOS, self.nome)
+        await pipe.execute()
+
+    async def adicionar(self, texto: str):
+        self.buffer += texto
+        if len(self.buffer) >= 20 * TRECHO_CHARS:
+            trechos = dividir_em_trechos(self.buffer)
+            # O ultimo trecho pode continuar no proximo bloco
+            self.buffer = trechos.pop()
+            await self._gravar(trechos)
+
+    async def progresso(self, lidas: int, total: int):
+        await r.hset(self.manifesto, mapping={"paginas_lidas": lidas, "paginas_total": total, "sinal": time.time()})
+
+    async def concluir(self):
+        await self._gravar(dividir_em_trechos(self.buffer))
+        self.buffer = ""
+        pipe = r.pipeline()
+        if self.trechos:
+            pipe.rename(self.novo, self.final)
+        else:
+            pipe.delete(self.final)
+        pipe.hset(self.manifesto, mapping={
+            "status": "pronto",
+            "caracteres": self.caracteres,
+            "trechos": self.trechos,
+            "atualizado": datetime.now().strftime("%d/%m/%Y %H:%M"),
+        })
+        pipe.incr(PROMPT_VERSAO_KEY)
+        await pipe.execute()
+        print(f"ARQUIVO {self.nome}: {self.caracteres} caracteres em {self.trechos} trechos")
+
+    async def falhar(self, erro: str):
+        pipe = r.pipeline()
+        pipe.delete(self.novo)
+        pipe.hset(self.manifesto, mapping={"status": "erro", "erro": erro[:300]})
+        await pipe.execute()
+
+    async def _gravar(self, trechos: list):
+        if not trechos:
+            return
+        pipe = r.pipeline()
+        pipe.rpush(self.novo, *[comprimir(t) for t in trechos])
+        pipe.hset(self.manifesto, "sinal", time.time())
+        await pipe.execute()
+        self.trechos    += len(trechos)
+        self.caracteres += sum(len(t) for t in trechos)
+
+
+async def ler_arquivo_enviado(nome: str, caminho: str, eh_pdf: bool):
+    """Roda em segundo plano depois do upload: le o arquivo salvo em disco aos poucos
+    (PDF de ARQUIVO_PAGINAS_LOTE em ARQUIVO_PAGINAS_LOTE paginas) e mostra o progresso no painel."""
+    gravador = GravadorDeArquivo(nome)
+    try:
+        await gravador.iniciar()
+        if eh_pdf:
+            total = await extrair_em_processo(_contar_paginas_pdf, caminho)
+            for inicio in range(0, total, ARQUIVO_PAGINAS_LOTE):
+                fim = min(inicio + ARQUIVO_PAGINAS_LOTE, total)
+                await gravador.adicionar(await extrair_em_processo(_extrair_paginas_pdf, caminho, inicio, fim) + "\n\n")
+                await gravador.progresso(fim, total)
+        else:
+            # Texto em UTF-8; se nao for, le de novo como latin-1 (que aceita qualquer byte)
+            for codificacao in ("utf-8", "latin-1"):
+                try:
+                    decodificador = codecs.getincrementaldecoder(codificacao)()
+                    with open(caminho, "rb") as f:
+                        while bloco := f.read(64 * 1024):
+                            await gravador.adicionar(decodificador.decode(bloco))
+                    await gravador.adicionar(decodificador.decode(b"", final=True))
+                    break
+                except UnicodeDecodeError:
+                    await gravador.iniciar()
+        await gravador.concluir()
+    except Exception as e:
+        print(f"ERRO ao ler arquivo {nome}: {e}")
+        await gravador.falhar(str(e) or type(e).__name__)
+    finally:
+        os.remove(caminho)
+
+async def injetar_arquivos_no_prompt(prompt: str) -> tuple[str, list]:
+    """Arquivos pequenos entram inteiros no lugar de [nome]. Os maiores que ARQUIVO_INTEGRAL_CHARS
+    ficam de fora: a cada mensagem vao so os trechos relevantes (ver trechos_relevantes).
+    Retorna (prompt, nomes dos arquivos grandes)."""
+    referencias = list(dict.fromkeys(re.findall(r'\[([a-zA-Z0-9_\-]+)\]', prompt)))
+    if not referencias:
+        return prompt, []
+    pipe = r.pipeline(transaction=False)
     for nome in referencias:
-        conteudo = obter_arquivo(nome)
-        if conteudo:
+        pipe.hget(f"{MANIFESTO_PREFIX}{nome}", "caracteres")
+    tamanhos = await pipe.execute()
+    grandes = []
+    for nome, tamanho in zip(referencias, tamanhos):
+        if not tamanho or not int(tamanho):
+            continue
+        if int(tamanho) <= ARQUIVO_INTEGRAL_CHARS:
+            conteudo = await obter_arquivo(nome)
             prompt = prompt.replace(f"[{nome}]", f"\n\n=== CONTEUDO DE '{nome}' ===\n{conteudo}\n=== FIM DE '{nome}' ===\n")
-    return prompt
+        else:
+            prompt = prompt.replace(f"[{nome}]", f"(arquivo '{nome}': os trechos relevantes para cada mensagem vem no fim destas instrucoes)")
+            grandes.append(nome)
+    return prompt, grandes
+
+# ------------------------------------------------------------
+# Busca nos arquivos grandes: BM25 sobre trechos de ~1000 caracteres
+# ------------------------------------------------------------
+TRECHO_CHARS = 1000
+
+PALAVRAS_VAZIAS = set("""a o e de da do das dos em no na nos nas um uma uns umas para pra por com sem
+que se ao aos as os ou mas mais menos como eu tu voce ele ela nos eles elas meu minha seu sua
+isso isto esta este esse essa aquele aquela ja nao sim muito pouco tem ter ser foi sao era
+quando onde qual quais porque pois tambem entao ate sobre entre""".split())
+
+def normalizar_texto(texto: str) -> str:
+    """Minusculas, sem acentos e sem pontuacao: "Olá, tudo bem?" -> "ola tudo bem"."""
+    texto = unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode()
+    return " ".join(re.findall(r"[a-z0-9]+", texto))
+
+def tokenizar(texto: str) -> list:
+    return [p for p in normalizar_texto(texto).split() if len(p) > 1 and p not in PALAVRAS_VAZIAS]
+
+def dividir_em_trechos(texto: str, tamanho: int = TRECHO_CHARS) -> list:
+    """Junta paragrafos ate ~`tamanho` caracteres; paragrafos maiores sao quebrados em espacos."""
+    trechos, atual = [], ""
+    for paragrafo in re.split(r"\n\s*\n", texto):
+        paragrafo = paragrafo.strip()
+        while len(paragrafo) > tamanho:
+            corte = paragrafo.rfind(" ", 0, tamanho)
+            corte = corte if corte > 0 else tamanho
+            if atual:
+                trechos.append(atual)
+                atual = ""
+            trechos.append(paragrafo[:corte])
+            paragrafo = paragrafo[corte:].strip()
+        if atual and len(atual) + len(paragrafo) + 2 > tamanho:
+            trechos.append(atual)
+            atual = ""
+        atual = f"{atual}\n\n{paragrafo}" if atual else paragrafo
+    if atual.strip():
+        trechos.append(atual)
+    return trechos
+
+class IndiceBM25:
+    """Para cada termo guarda em quais trechos ele aparece e o peso BM25 ja calculado;
+    a busca so soma os vetores dos termos da mensagem."""
+
+    def __init__(self, trechos: list, k1: float = 1.5, b: float = 0.75):
+        self.trechos = trechos  # [(nome do arquivo, texto)]
+        documentos = [Counter(tokenizar(texto)) for _, texto in trechos]
+        tamanhos   = np.array([sum(d.values()) for d in documentos], dtype=np.float32)
+        media      = max(float(tamanhos.mean()), 1.0) if len(tamanhos) else 1.0
+
+        ocorrencias: dict = {}
+        for i, documento in enumerate(documentos):
+            for termo, frequencia in documento.items():
+                ids, freqs = ocorrencias.setdefault(termo, ([], []))
+                ids.append(i)
+                freqs.append(frequencia)
+
+        self.termos: dict = {}
+        for termo, (ids, freqs) in ocorrencias.items():
+            ids   = np.array(ids, dtype=np.int32)
+            freqs = np.array(freqs, dtype=np.float32)
+            idf   = np.log(1 + (len(trechos) - len(ids) + 0.5) / (len(ids) + 0.5))
+            self.termos[termo] = (ids, idf * freqs * (k1 + 1) / (freqs + k1 * (1 - b + b * tamanhos[ids] / media)))
+
+    def buscar(self, consulta: str, k: int) -> list:
+        pontos = np.zeros(len(self.trechos), dtype=np.float32)
+        for termo in set(tokenizar(consulta)):
+            if termo in self.termos:
+                ids, pesos = self.termos[termo]
+                pontos[ids] += pesos
+        melhores = [i for i in np.argsort(-pontos)[:k] if pontos[i] > 0]
+        # Na ordem do arquivo, que fica mais facil de ler que por pontuacao
+        return [self.trechos[i] for i in sorted(melhores)]
+
+def _montar_indice(nomes: list, listas: list) -> IndiceBM25:
+    return IndiceBM25([(nome, descomprimir(trecho)) for nome, trechos in zip(nomes, listas) for trecho in trechos])
+
+async def montar_indice_arquivos(nomes: list) -> IndiceBM25:
+    """Descomprimir e indexar milhares de trechos leva tempo de CPU: roda numa thread,
+    sem parar o event loop (e as outras conversas) enquanto isso."""
+    pipe = r.pipeline(transaction=False)
+    for nome in nomes:
+        pipe.lrange(f"{TRECHOS_PREFIX}{nome}", 0, -1)
+    listas = await pipe.execute()
+    return await asyncio.get_running_loop().run_in_executor(None, _montar_indice, nomes, listas)
 
 # ============================================================
 # ASSINATURAS
 # ============================================================
 ASSINATURA_PREFIX = "assinatura:"
 CONSULTA_PREFIX   = "consulta:"
-
-def obter_assinatura(telefone: str) -> dict:
-    dados = r.get(f"{ASSINATURA_PREFIX}{telefone}")
+IDX_ASSINATURAS   = "idx:assinaturas"  # zset telefone -> vencimento (timestamp)
+IDX_CONSULTAS     = "idx:consultas"    # zset telefone -> data do pedido (timestamp)
+# Conjuntos mantidos a cada gravacao; o painel so conta os membros (SCARD)
+IDX_PREMIUM              = "idx:premium"              # telefones com status "ativo"
+IDX_VENCIMENTOS          = "idx:vencimentos"          # zset so das ativas com vencimento: telefone -> vencimento
+IDX_CONSULTAS_PENDENTES  = "idx:consultas:pendentes"  # telefones com consulta nao atendida
+
+async def obter_assinatura(telefone: str) -> dict:
+    dados = await r.get(f"{ASSINATURA_PREFIX}{telefone}")
     if not dados:
         return {"status": "freemium", "plano": "freemium", "telefone": telefone}
     return json.loads(dados)
 
-def salvar_assinatura(telefone: str, dados: dict):
-    r.set(f"{ASSINATURA_PREFIX}{telefone}", json.dumps(dados))
-
-def eh_premium(telefone: str) -> bool:
-    assinatura = obter_assinatura(telefone)
+async def salvar_assinatura(telefone: str, dados: dict, pipe=None):
+    """Com `pipe`, so enfileira os comandos — quem chamou executa junto com o resto do lote."""
+    lote = pipe if pipe is not None else r.pipeline()
+    lote.set(f"{ASSINATURA_PREFIX}{telefone}", json.dumps(dados))
+    lote.zadd(IDX_ASSINATURAS, {telefone: timestamp_iso(dados.get("expira"))})
+    lote.hset(f"{RESUMO_PREFIX}{telefone}", mapping={"status": dados.get("status", ""), "expira": dados.get("expira") or ""})
+    vencimento = timestamp_iso(dados.get("expira"))
+    if dados.get("status") == "ativo":
+        lote.sadd(IDX_PREMIUM, telefone)
+    else:
+        lote.srem(IDX_PREMIUM, telefone)
+    if dados.get("status") == "ativo" and vencimento:
+        lote.zadd(IDX_VENCIMENTOS, {telefone: vencimento})
+    else:
+        lote.zrem(IDX_VENCIMENTOS, telefone)
+    if pipe is None:
+        await lote.execute()
+
+async def apagar_assinatura_dados(telefone: str):
+    pipe = r.pipeline()
+    pipe.delete(f"{ASSINATURA_PREFIX}{telefone}")
+    pipe.zrem(IDX_ASSINATURAS, telefone)
+    pipe.hdel(f"{RESUMO_PREFIX}{telefone}", "status", "expira")
+    pipe.srem(IDX_PREMIUM, telefone)
+    pipe.zrem(IDX_VENCIMENTOS, telefone)
+    await pipe.execute()
+
+def assinatura_ativa(assinatura: dict) -> bool:
     if assinatura.get("status") != "ativo":
         return False
     # Verifica vencimento se existir
@@ -129,76 +629,571 @@ def eh_premium(telefone: str) -> bool:
             pass
     return True
 
-def listar_assinaturas() -> list:
-    chaves = r.keys(f"{ASSINATURA_PREFIX}*")
-    resultado = []
-    for chave in sorted(chaves):
-        dados = json.loads(r.get(chave) or "{}")
-        resultado.append(dados)
-    return resultado
+async def eh_premium(telefone: str) -> bool:
+    # Vencimentos sao aplicados pela varredura abaixo, entao basta olhar o conjunto
+    return bool(await r.sismember(IDX_PREMIUM, telefone))
+
+MENSAGEM_RENOVACAO = "Seu acesso Premium venceu 💙\n\nPara continuar com as orientacoes completas, e so renovar por aqui:\n{link}"
+
+async def varrer_assinaturas_vencidas() -> int:
+    """Marca como inativas as assinaturas ativas cujo vencimento ja passou. Le so o indice das
+    ativas com vencimento: ao virar inativa, a assinatura sai dele, entao cada varredura custa
+    o numero de vencidas desde a ultima, e nao o de todas que ja venceram um dia."""
+    vencidas = await r.zrangebyscore(IDX_VENCIMENTOS, "-inf", time.time(), start=0, num=1000)
+    if not vencidas:
+        return 0
+
+    registros = await r.mget([f"{ASSINATURA_PREFIX}{tel}" for tel in vencidas])
+    pipe = r.pipeline()
+    for telefone, registro in zip(vencidas, registros):
+        dados = json.loads(registro) if registro else {"telefone": telefone, "plano": "premium"}
+        dados["status"] = "inativo"
+        dados["vencida_em"] = datetime.now().isoformat()
+        await salvar_assinatura(telefone, dados, pipe)
+    await pipe.execute()
+    print(f"ASSINATURAS: {len(vencidas)} vencidas marcadas como inativas")
+
+    if AVISO_RENOVACAO:
+        # A fila de envio respeita o limite da Z-API, entao pode enfileirar todos de uma vez
+        for telefone in vencidas:
+            await enviar_whatsapp(telefone, MENSAGEM_RENOVACAO.format(link=obter_link_pagamento(telefone)))
+    return len(vencidas)
+
+async def varrer_assinaturas_periodicamente():
+    # Refaz os indices uma vez ao subir, para o de vencimentos existir mesmo em bases antigas
+    try:
+        await reconciliar_contadores()
+    except Exception as e:
+        print(f"ERRO ao reconciliar contadores: {e}")
+    while True:
+        try:
+            await varrer_assinaturas_vencidas()
+        except Exception as e:
+            print(f"ERRO ao varrer assinaturas: {e}")
+        await asyncio.sleep(ASSINATURAS_VARRER)
+
+async def listar_assinaturas() -> list:
+    """Assinaturas ordenadas pelo vencimento, as que vencem primeiro no topo."""
+    telefones = await r.zrange(IDX_ASSINATURAS, 0, -1)
+    return await carregar_json([f"{ASSINATURA_PREFIX}{tel}" for tel in telefones])
 
-def registrar_interesse_consulta(telefone: str, nome: str):
+async def registrar_interesse_consulta(telefone: str, nome: str, pipe=None):
+    """Com `pipe`, so enfileira os comandos — quem chamou executa junto com o resto do lote."""
     dados = {
         "telefone": telefone,
         "nome": nome,
         "data": datetime.now().strftime("%d/%m/%Y %H:%M"),
         "atendido": False
     }
-    r.set(f"{CONSULTA_PREFIX}{telefone}", json.dumps(dados))
-
-def listar_consultas() -> list:
-    chaves = r.keys(f"{CONSULTA_PREFIX}*")
-    resultado = []
-    for chave in sorted(chaves):
-        dados = json.loads(r.get(chave) or "{}")
-        resultado.append(dados)
-    return resultado
-
-def marcar_consulta_atendida(telefone: str):
-    dados = json.loads(r.get(f"{CONSULTA_PREFIX}{telefone}") or "{}")
+    lote = pipe if pipe is not None else r.pipeline()
+    lote.set(f"{CONSULTA_PREFIX}{telefone}", json.dumps(dados))
+    lote.zadd(IDX_CONSULTAS, {telefone: time.time()})
+    lote.sadd(IDX_CONSULTAS_PENDENTES, telefone)
+    if pipe is None:
+        await lote.execute()
+
+async def listar_consultas() -> list:
+    """Consultas na ordem em que foram pedidas."""
+    telefones = await r.zrange(IDX_CONSULTAS, 0, -1)
+    return await carregar_json([f"{CONSULTA_PREFIX}{tel}" for tel in telefones])
+
+async def marcar_consulta_atendida(telefone: str):
+    dados = json.loads(await r.get(f"{CONSULTA_PREFIX}{telefone}") or "{}")
     dados["atendido"] = True
-    r.set(f"{CONSULTA_PREFIX}{telefone}", json.dumps(dados))
+    pipe = r.pipeline()
+    pipe.set(f"{CONSULTA_PREFIX}{telefone}", json.dumps(dados))
+    pipe.srem(IDX_CONSULTAS_PENDENTES, telefone)
+    await pipe.execute()
+
+async def contadores_painel() -> dict:
+    pipe = r.pipeline()
+    pipe.zcard(IDX_USUARIOS)
+    pipe.scard(IDX_PREMIUM)
+    pipe.scard(IDX_CONSULTAS_PENDENTES)
+    usuarios, premium, consultas = await pipe.execute()
+    return {"usuarios": usuarios, "premium": premium, "consultas": consultas}
+
+async def reconciliar_contadores() -> dict:
+    """Refaz os conjuntos do painel a partir dos dados, corrigindo qualquer diferenca
+    (gravacao interrompida, chave editada na mao). Le pelos indices, sem varrer o keyspace."""
+    antes = await contadores_painel()
+    pipe = r.pipeline()
+    pipe.zrange(IDX_ASSINATURAS, 0, -1, withscores=True)
+    pipe.zrange(IDX_CONSULTAS, 0, -1)
+    com_assinatura, com_consulta = await pipe.execute()
+    assinaturas = await r.mget([f"{ASSINATURA_PREFIX}{tel}" for tel, _ in com_assinatura]) if com_assinatura else []
+    consultas   = await r.mget([f"{CONSULTA_PREFIX}{tel}" for tel in com_consulta]) if com_consulta else []
+    premium   = {tel: vencimento for (tel, vencimento), dados in zip(com_assinatura, assinaturas)
+                 if dados and json.loads(dados).get("status") == "ativo"}
+    pendentes = [tel for tel, dados in zip(com_consulta, consultas) if dados and not json.loads(dados).get("atendido")]
+    pipe = r.pipeline()
+    for chave, membros in ((IDX_PREMIUM, list(premium)), (IDX_CONSULTAS_PENDENTES, pendentes)):
+        pipe.delete(chave)
+        if membros:
+            pipe.sadd(chave, *membros)
+    pipe.delete(IDX_VENCIMENTOS)
+    if vencimentos := {tel: vencimento for tel, vencimento in premium.items() if vencimento}:
+        pipe.zadd(IDX_VENCIMENTOS, vencimentos)
+    await pipe.execute()
+    depois = await contadores_painel()
+    if antes != depois:
+        print(f"CONTADORES: corrigidos de {antes} para {depois}")
+    return depois
+
+async def reconciliar_contadores_periodicamente():
+    while True:
+        await asyncio.sleep(CONTADORES_RECONCILIAR)
+        try:
+            await reconciliar_contadores()
+        except Exception as e:
+            print(f"ERRO ao reconciliar contadores: {e}")
 
 # ============================================================
-# HISTORICO COM REDIS
+# HISTORICO COM REDIS — lista, uma mensagem JSON por item
 # ============================================================
-HISTORICO_LIMITE = 40
-
-def obter_historico(telefone: str) -> list:
-    dados = r.get(f"historico:{telefone}")
-    if not dados:
-        return []
-    return json.loads(dados)[-HISTORICO_LIMITE:]
-
-def salvar_historico(telefone: str, historico: list):
-    r.set(f"historico:{telefone}", json.dumps(historico))
+HISTORICO_PREFIX = "historico:"
+HISTORICO_LIMITE = 40    # mensagens enviadas ao Claude
+HISTORICO_MAXIMO = 200   # mensagens guardadas por usuario
+IDX_USUARIOS     = "idx:usuarios"  # zset telefone -> ultima mensagem (timestamp)
+IDX_TELEFONES    = "idx:telefones" # zset com score 0: ordem alfabetica e busca por prefixo (ZRANGEBYLEX)
+RESUMO_PREFIX    = "resumo:"       # hash por usuario para o painel: msgs, ultima, status, expira
+
+async def obter_historico(telefone: str) -> list:
+    itens = await r.lrange(f"{HISTORICO_PREFIX}{telefone}", -HISTORICO_LIMITE, -1)
+    return [json.loads(item) for item in itens]
+
+async def salvar_mensagem(telefone: str, role: str, conteudo: str, pipe=None):
+    """Com `pipe`, so enfileira os comandos — quem chamou executa junto com o resto do lote."""
+    chave = f"{HISTORICO_PREFIX}{telefone}"
+    lote = pipe if pipe is not None else r.pipeline()
+    lote.rpush(chave, json.dumps({"role": role, "content": conteudo}))
+    lote.ltrim(chave, -HISTORICO_MAXIMO, -1)
+    lote.zadd(IDX_USUARIOS, {telefone: time.time()})
+    lote.zadd(IDX_TELEFONES, {telefone: 0})
+    lote.hincrby(f"{RESUMO_PREFIX}{telefone}", "msgs", 1)
+    lote.hincrby(f"{RESUMO_CONVERSA_PREFIX}{telefone}", "posicao", 1)
+    lote.hset(f"{RESUMO_PREFIX}{telefone}", "ultima", conteudo[:80])
+    if pipe is None:
+        await lote.execute()
+
+async def apagar_historico_dados(telefone: str):
+    pipe = r.pipeline()
+    pipe.delete(f"{HISTORICO_PREFIX}{telefone}")
+    pipe.zrem(IDX_USUARIOS, telefone)
+    pipe.zrem(IDX_TELEFONES, telefone)
+    pipe.hdel(f"{RESUMO_PREFIX}{telefone}", "msgs", "ultima")
+    pipe.delete(f"{RESUMO_CONVERSA_PREFIX}{telefone}")
+    await pipe.execute()
+
+TURNO_GRAVADO_PREFIX = "turno:gravado:"  # id do job da fila cuja mensagem do usuario ja esta no historico
+TURNO_GRAVADO_DIAS   = 7                 # cobre novas tentativas e o "Reprocessar" do painel
+
+async def carregar_turno(telefone: str, mensagem_usuario: str, id_turno: str | None = None, repetido: bool = False) -> dict:
+    """Grava a mensagem do usuario e le tudo que o turno precisa em uma unica transacao:
+    historico ja com a mensagem nova, versoes do prompt e das regras de intencao, se e premium,
+    se ja existe pedido de consulta, quantas mensagens a conversa ja teve, o resumo da parte
+    antiga e, para o roteador de modelos, os orcamentos diarios de tokens e o uso de hoje.
+
+    Com `id_turno`, a gravacao fica marcada; numa nova tentativa do mesmo job (`repetido`)
+    a mensagem so e gravada se a tentativa anterior nao chegou a grava-la."""
+    gravar = not (repetido and id_turno and await r.exists(f"{TURNO_GRAVADO_PREFIX}{id_turno}"))
+    pipe = r.pipeline()
+    if gravar:
+        await salvar_mensagem(telefone, "user", mensagem_usuario, pipe)
+        if id_turno:
+            pipe.set(f"{TURNO_GRAVADO_PREFIX}{id_turno}", 1, ex=TURNO_GRAVADO_DIAS * 86400)
+    pipe.lrange(f"{HISTORICO_PREFIX}{telefone}", -(HISTORICO_LIMITE + RESUMO_LOTE), -1)
+    pipe.get(PROMPT_VERSAO_KEY)
+    pipe.get(INTENCOES_VERSAO_KEY)
+    pipe.sismember(IDX_PREMIUM, telefone)
+    pipe.exists(f"{CONSULTA_PREFIX}{telefone}")
+    pipe.hget(f"{RESUMO_PREFIX}{telefone}", "msgs")
+    pipe.hgetall(f"{RESUMO_CONVERSA_PREFIX}{telefone}")
+    pipe.hgetall(ORCAMENTO_TOKENS_KEY)
+    pipe.hgetall(f"{LLM_USO_PREFIX}{datetime.now():%Y-%m-%d}")
+    *_, historico, prompt_versao, intencoes_versao, premium, tem_consulta, total_msgs, resumo, orcamentos, uso = await pipe.execute()
+    if not gravar:
+        print(f"TURNO {telefone}: mensagem ja gravada na tentativa anterior ({id_turno})")
+    # "posicao" numera as mensagens para o resumo; o "msgs" do painel volta ao tamanho da lista
+    # no reindexar. Conversa anterior ao contador comeca pela contagem do painel (ou pelo fim
+    # do resumo, se um reindexar antigo deixou a contagem para tras)
+    posicao = int(resumo.get("posicao", 0))
+    inicial = max(int(total_msgs or 0), int(resumo.get("ate", 0)))
+    if posicao < inicial:
+        posicao = await r.hincrby(f"{RESUMO_CONVERSA_PREFIX}{telefone}", "posicao", inicial - posicao)
+        resumo["posicao"] = posicao
+    return {
+        "orcamentos": {modelo: int(valor) for modelo, valor in orcamentos.items()},
+        "uso": {campo: int(valor) for campo, valor in uso.items()},
+        "historico": [json.loads(item) for item in historico],
+        "total_msgs": posicao or len(historico),
+        "resumo": resumo,
+        "prompt_versao": prompt_versao,
+        "intencoes_versao": intencoes_versao,
+        "premium": bool(premium),
+        "tem_consulta": bool(tem_consulta),
+    }
 
-def salvar_mensagem(telefone: str, role: str, conteudo: str):
-    historico = obter_historico(telefone)
-    historico.append({"role": role, "content": conteudo})
-    salvar_historico(telefone, historico)
+BUSCA_ORDENAR_MAX = 1000  # busca com mais resultados que isso e paginada por telefone, sem ordenar por atividade
+
+async def listar_usuarios(pagina: int, por_pagina: int, busca: str = "", ordem: str = "recentes") -> tuple[list, int, str]:
+    """Uma pagina de usuarios com o resumo de cada um. Retorna (usuarios, total encontrado, ordem usada).
+    A busca e por prefixo do telefone; com ordem "recentes" os encontrados sao ordenados
+    pela ultima atividade antes de paginar. Prefixo curto demais (ex: "55") casa com quase
+    todos: passando de BUSCA_ORDENAR_MAX resultados, a pagina sai por ordem de telefone."""
+    inicio = (pagina - 1) * por_pagina
+    if busca:
+        minimo, maximo = f"[{busca}", f"[{busca}\xff"
+        if ordem == "recentes" and await r.zlexcount(IDX_TELEFONES, minimo, maximo) > BUSCA_ORDENAR_MAX:
+            ordem = "telefone"
+        if ordem == "telefone":
+            pipe = r.pipeline()
+            pipe.zrangebylex(IDX_TELEFONES, minimo, maximo, start=inicio, num=por_pagina)
+            pipe.zlexcount(IDX_TELEFONES, minimo, maximo)
+            telefones, total = await pipe.execute()
+        else:
+            encontrados = await r.zrangebylex(IDX_TELEFONES, minimo, maximo)
+            atividade = await r.zmscore(IDX_USUARIOS, encontrados) if encontrados else []
+            ordenados = sorted(zip(encontrados, atividade), key=lambda par: par[1] or 0, reverse=True)
+            telefones, total = [t for t, _ in ordenados[inicio:inicio + por_pagina]], len(encontrados)
+    else:
+        pipe = r.pipeline()
+        if ordem == "telefone":
+            pipe.zrange(IDX_TELEFONES, inicio, inicio + por_pagina - 1)
+        else:
+            pipe.zrevrange(IDX_USUARIOS, inicio, inicio + por_pagina - 1)
+        pipe.zcard(IDX_USUARIOS)
+        telefones, total = await pipe.execute()
+
+    pipe = r.pipeline(transaction=False)
+    for telefone in telefones:
+        pipe.hgetall(f"{RESUMO_PREFIX}{telefone}")
+    resumos = await pipe.execute() if telefones else []
+    return [{"telefone": t, **resumo} for t, resumo in zip(telefones, resumos)], total, ordem
+
+async def migrar_historicos() -> int:
+    """Converte historicos antigos (lista inteira em uma string JSON) para o formato
+    de lista do Redis. Chaves ja convertidas sao ignoradas, entao pode rodar mais de uma vez."""
+    migrados = 0
+    async for chave in r.scan_iter(f"{HISTORICO_PREFIX}*", count=500):
+        if await r.type(chave) != "string":
+            continue
+        mensagens = json.loads(await r.get(chave) or "[]")[-HISTORICO_MAXIMO:]
+        pipe = r.pipeline()
+        pipe.delete(chave)
+        if mensagens:
+            pipe.rpush(chave, *[json.dumps(m) for m in mensagens])
+        await pipe.execute()
+        migrados += 1
+    print(f"MIGRACAO: {migrados} historicos convertidos para lista")
+    return migrados
+
+async def reindexar() -> int:
+    """Reconstroi os indices (idx:*) a partir dos dados. Usuarios sem data de atividade
+    conhecida entram com timestamp 0 e aparecem no fim da lista ate mandarem nova mensagem."""
+    total = 0
+    pipe = r.pipeline(transaction=False)
+    async for chave in r.scan_iter(f"{HISTORICO_PREFIX}*", count=500):
+        telefone = chave.replace(HISTORICO_PREFIX, "", 1)
+        ultima = await r.lindex(chave, -1)
+        pipe.zadd(IDX_USUARIOS, {telefone: 0}, nx=True)
+        pipe.zadd(IDX_TELEFONES, {telefone: 0})
+        pipe.hset(f"{RESUMO_PREFIX}{telefone}", mapping={
+            "msgs": await r.llen(chave),
+            "ultima": json.loads(ultima)["content"][:80] if ultima else "",
+        })
+        total += 1
+    async for chave in r.scan_iter(f"{MANIFESTO_PREFIX}*", count=500):
+        pipe.sadd(IDX_ARQUIVOS, chave.replace(MANIFESTO_PREFIX, "", 1))
+        total += 1
+    async for chave in r.scan_iter(f"{ARQUIVO_PREFIX}*", count=500):
+        # Arquivo no formato antigo (texto inteiro numa string): regrava em trechos comprimidos
+        nome = chave.replace(ARQUIVO_PREFIX, "", 1)
+        gravador = GravadorDeArquivo(nome)
+        await gravador.iniciar()
+        await gravador.adicionar(await r.get(chave) or "")
+        await gravador.concluir()
+        await r.delete(chave)
+        total += 1
+    async for chave in r.scan_iter(f"{ASSINATURA_PREFIX}*", count=500):
+        dados = json.loads(await r.get(chave) or "{}")
+        telefone = chave.replace(ASSINATURA_PREFIX, "", 1)
+        pipe.zadd(IDX_ASSINATURAS, {telefone: timestamp_iso(dados.get("expira"))})
+        pipe.hset(f"{RESUMO_PREFIX}{telefone}", mapping={"status": dados.get("status", ""), "expira": dados.get("expira") or ""})
+        total += 1
+    async for chave in r.scan_iter(f"{CONSULTA_PREFIX}*", count=500):
+        dados = json.loads(await r.get(chave) or "{}")
+        try:
+            pedido = datetime.strptime(dados.get("data", ""), "%d/%m/%Y %H:%M").timestamp()
+        except ValueError:
+            pedido = 0
+        pipe.zadd(IDX_CONSULTAS, {chave.replace(CONSULTA_PREFIX, "", 1): pedido})
+        total += 1
+    await pipe.execute()
+    await reconciliar_contadores()
+    print(f"REINDEXACAO: {total} chaves indexadas")
+    return total
 
 # ============================================================
 # PROCESSAMENTO DE MIDIA
 # ============================================================
+TEXTO_MIDIA_LIMITE = 8000  # caracteres de PDF/planilha repassados ao Claude
+
+# Leitura de PDF/planilha e pesada e sincrona: roda em processos separados para nao travar
+# as outras conversas. Sem o pool (ex: comandos de manutencao) cai no pool de threads padrao.
+processos_extracao: ProcessPoolExecutor | None = None
+# Um job por processo: o que esta esperando vaga espera aqui, fora do pool, entao o limite
+# de tempo abaixo so conta a partir de quando o job comecou a rodar
+extracao_semaforo = asyncio.Semaphore(EXTRACAO_PROCESSOS)
+
+class ArquivoGrandeDemais(Exception):
+    pass
+
+class ExtracaoDemorada(Exception):
+    pass
+
+
+def _extrair_pdf(conteudo: bytes, max_paginas: int, limite: int) -> str:
+    """Para de ler assim que junta `limite` caracteres, em vez de ler tudo e cortar depois."""
+    import pdfplumber
+    paginas, total = [], 0
+    with pdfplumber.open(io.BytesIO(conteudo)) as pdf:
+        for i, pagina in enumerate(pdf.pages[:max_paginas]):
+            texto = pagina.extract_text()
+            pagina.close()
+            if not texto:
+                continue
+            paginas.append(f"[Pagina {i+1}]\n{texto}")
+            total += len(paginas[-1]) + 2
+            if total >= limite:
+                break
+    return "\n\n".join(paginas)[:limite]
+
+
+def _contar_paginas_pdf(caminho: str) -> int:
+    import pdfplumber
+    with pdfplumber.open(caminho) as pdf:
+        return len(pdf.pages)
+
+
+def _extrair_paginas_pdf(caminho: str, inicio: int, fim: int) -> str:
+    """Le so as paginas [inicio, fim) do PDF salvo em disco, para o upload ler em lotes."""
+    import pdfplumber
+    paginas = []
+    with pdfplumber.open(caminho) as pdf:
+        for pagina in pdf.pages[inicio:fim]:
+            texto = pagina.extract_text()
+            pagina.close()
+            if texto:
+                paginas.append(texto)
+    return "\n\n".join(paginas)
+
+
+def _extrair_excel(conteudo: bytes, limite: int) -> str:
+    import openpyxl
+    wb = openpyxl.load_workbook(io.BytesIO(conteudo), read_only=True, data_only=True)
+    linhas_total, total = [], 0
+    for nome_aba in wb.sheetnames[:3]:
+        ws = wb[nome_aba]
+        linhas_total.append(f"[Aba: {nome_aba}]")
+        for i, row in enumerate(ws.iter_rows(values_only=True)):
+            if i >= 100:
+                linhas_total.append("... (mais linhas omitidas)")
+                break
+            linha = " | ".join(str(c) if c is not None else "" for c in row)
+            if linha.strip():
+                linhas_total.append(linha)
+                total += len(linha) + 1
+            if total >= limite:
+                break
+        if total >= limite:
+            break
+    wb.close()
+    return "\n".join(linhas_total)[:limite]
+
+
+def _extrair_com_limite(funcao, segundos: float, *args):
+    """Roda dentro do processo de extracao: o proprio processo interrompe a leitura quando
+    passa de `segundos` e fica livre para o proximo arquivo. Fora da thread principal
+    (pool de threads dos comandos de manutencao) nao ha alarme e vale so o limite de fora."""
+    if threading.current_thread() is not threading.main_thread():
+        return funcao(*args)
+
+    def estourou(*_):
+        raise ExtracaoDemorada(f"extracao passou de {segundos:g}s")
+
+    anterior = signal.signal(signal.SIGALRM, estourou)
+    signal.setitimer(signal.ITIMER_REAL, segundos)
+    try:
+        return funcao(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, anterior)
+
+
+def reciclar_processos_extracao(pool: ProcessPoolExecutor):
+    """Troca o pool quando um processo ficou preso (ex: em codigo C que ignora o alarme):
+    os processos antigos sao encerrados e as proximas extracoes vao para processos novos."""
+    global processos_extracao
+    if processos_extracao is not pool:
+        return  # outra extracao ja trocou
+    processos_extracao = ProcessPoolExecutor(max_workers=EXTRACAO_PROCESSOS)
+    processos = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for processo in processos:
+        processo.terminate()
+    print(f"EXTRACAO: {len(processos)} processos presos encerrados, pool recriado")
+
+
+async def extrair_em_processo(funcao, *args) -> str:
+    loop = asyncio.get_running_loop()
+    async with extracao_semaforo:
+        pool = processos_extracao
+        try:
+            # O limite de dentro do processo dispara primeiro; o de fora so pega processo travado
+            return await asyncio.wait_for(
+                loop.run_in_executor(pool, _extrair_com_limite, funcao, EXTRACAO_TIMEOUT, *args),
+                EXTRACAO_TIMEOUT + 5
+            )
+        except asyncio.TimeoutError:
+            if pool is not None:
+                reciclar_processos_extracao(pool)
+            raise
+
+
+async def baixar_midia(url: str) -> bytes:
+    """Baixa em pedacos e desiste assim que passar de MIDIA_MAX_MB, sem carregar o resto."""
+    limite = int(MIDIA_MAX_MB * 1024 * 1024)
+    with medir_servico("midia"):
+        async with http_clientes["midia"].stream("GET", url) as resposta:
+            resposta.raise_for_status()
+            if int(resposta.headers.get("content-length") or 0) > limite:
+                raise ArquivoGrandeDemais(f"{url} maior que {MIDIA_MAX_MB:g} MB")
+            partes, total = [], 0
+            async for parte in resposta.aiter_bytes():
+                total += len(parte)
+                if total > limite:
+                    raise ArquivoGrandeDemais(f"{url} maior que {MIDIA_MAX_MB:g} MB")
+                partes.append(parte)
+    return b"".join(partes)
+
+
+async def salvar_upload(arquivo: UploadFile, limite: int) -> str:
+    """Copia o upload para um arquivo temporario em pedacos e retorna o caminho.
+    Quem chamou apaga o arquivo depois de usar."""
+    total = 0
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(arquivo.filename or "")[1]) as destino:
+        while parte := await arquivo.read(64 * 1024):
+            total += len(parte)
+            if total > limite:
+                destino.close()
+                os.remove(destino.name)
+                raise ArquivoGrandeDemais(f"{arquivo.filename} maior que {limite // 1024} KB")
+            destino.write(parte)
+    return destino.name
+
+
+# ------------------------------------------------------------
+# Cache por conteudo: o mesmo audio/PDF/planilha encaminhado de novo (por qualquer usuario)
+# reaproveita a transcricao/leitura anterior, sem pagar Groq nem CPU outra vez
+# ------------------------------------------------------------
+CACHE_MIDIA_PREFIX    = "cache:midia:"
+CACHE_MIDIA_IDX       = "cache:midia:idx"        # zset chave -> ultimo uso (timestamp)
+CACHE_MIDIA_TAMANHOS  = "cache:midia:tamanhos"   # hash chave -> bytes
+CACHE_MIDIA_BYTES     = "cache:midia:bytes"      # total de bytes guardados
+CACHE_MIDIA_METRICAS  = "metricas:cache_midia"   # hash com acertos/falhas por tipo
+
+def chave_cache_midia(tipo: str, conteudo: bytes) -> str:
+    return f"{CACHE_MIDIA_PREFIX}{tipo}:{hashlib.sha256(conteudo).hexdigest()}"
+
+async def buscar_cache_midia(chave: str) -> str | None:
+    tipo  = chave.split(":")[2]
+    texto = await r.get(chave)
+    pipe  = r.pipeline()
+    # So o acerto conta como uso: numa falha a entrada (se ainda estiver no indice, ja vencida)
+    # continua na frente da fila para a limpeza
+    if texto:
+        pipe.expire(chave, int(MIDIA_CACHE_DIAS * 86400))
+        pipe.zadd(CACHE_MIDIA_IDX, {chave: time.time()}, xx=True)
+    pipe.hincrby(CACHE_MIDIA_METRICAS, f"{tipo}:{'acertos' if texto else 'falhas'}", 1)
+    await pipe.execute()
+    return texto
+
+async def guardar_cache_midia(chave: str, texto: str):
+    tamanho = len(texto.encode())
+    # Regravar uma chave (ex: vencida mas ainda no indice) troca o tamanho antigo pelo novo
+    anterior = int(await r.hget(CACHE_MIDIA_TAMANHOS, chave) or 0)
+    pipe = r.pipeline()
+    pipe.set(chave, texto, ex=int(MIDIA_CACHE_DIAS * 86400))
+    pipe.zadd(CACHE_MIDIA_IDX, {chave: time.time()})
+    pipe.hset(CACHE_MIDIA_TAMANHOS, chave, tamanho)
+    pipe.incrby(CACHE_MIDIA_BYTES, tamanho - anterior)
+    await pipe.execute()
+    await aplicar_limites_cache_midia()
+
+async def aplicar_limites_cache_midia():
+    """Remove as entradas vencidas e, se o total passar de MIDIA_CACHE_MB, as usadas ha mais
+    tempo. Roda a cada gravacao e olha no maximo 100 entradas por vez."""
+    vencimento = time.time() - MIDIA_CACHE_DIAS * 86400
+    limite     = MIDIA_CACHE_MB * 1024 * 1024
+    candidatas = await r.zrange(CACHE_MIDIA_IDX, 0, 99, withscores=True)
+    if not candidatas:
+        return
+    pipe = r.pipeline()
+    pipe.get(CACHE_MIDIA_BYTES)
+    pipe.hmget(CACHE_MIDIA_TAMANHOS, [chave for chave, _ in candidatas])
+    total, tamanhos = await pipe.execute()
+    total = int(total or 0)
+
+    remover, liberado = [], 0
+    for (chave, ultimo_uso), tamanho in zip(candidatas, tamanhos):
+        if ultimo_uso >= vencimento and total - liberado <= limite:
+            break
+        remover.append(chave)
+        liberado += int(tamanho or 0)
+    if remover:
+        pipe = r.pipeline()
+        pipe.delete(*remover)
+        pipe.zrem(CACHE_MIDIA_IDX, *remover)
+        pipe.hdel(CACHE_MIDIA_TAMANHOS, *remover)
+        pipe.decrby(CACHE_MIDIA_BYTES, liberado)
+        await pipe.execute()
+
+async def resumo_cache_midia() -> dict:
+    pipe = r.pipeline()
+    pipe.hgetall(CACHE_MIDIA_METRICAS)
+    pipe.zcard(CACHE_MIDIA_IDX)
+    pipe.get(CACHE_MIDIA_BYTES)
+    contadores, entradas, total = await pipe.execute()
+    return {
+        "contadores": {campo: int(valor) for campo, valor in contadores.items()},
+        "entradas": entradas,
+        "bytes": int(total or 0),
+    }
+
 
 async def transcrever_audio(url_audio: str) -> str:
     if not GROQ_API_KEY:
         return "[Audio recebido, mas GROQ_API_KEY nao configurada]"
     try:
-        async with httpx.AsyncClient(timeout=60) as http:
-            r_audio = await http.get(url_audio)
-            conteudo = r_audio.content
-            response = await http.post(
-                "https://api.groq.com/openai/v1/audio/transcriptions",
-                headers={"Authorization": f"Bearer {GROQ_API_KEY}"},
-                files={"file": ("audio.ogg", conteudo, "audio/ogg")},
-                data={"model": "whisper-large-v3", "language": "pt"}
-            )
-            if response.status_code == 200:
-                texto = response.json().get("text", "")
-                return f"[Audio transcrito]: {texto}"
-            return "[Nao foi possivel transcrever o audio]"
+        conteudo = await baixar_midia(url_audio)
+        chave = chave_cache_midia("audio", conteudo)
+        if texto_cache := await buscar_cache_midia(chave):
+            return texto_cache
+        response = await requisitar(
+            "groq", "POST",
+            "https://api.groq.com/openai/v1/audio/transcriptions",
+            headers={"Authorization": f"Bearer {GROQ_API_KEY}"},
+            files={"file": ("audio.ogg", conteudo, "audio/ogg")},
+            data={"model": "whisper-large-v3", "language": "pt"}
+        )
+        if response.status_code == 200:
+            texto = f"[Audio transcrito]: {response.json().get('text', '')}"
+            await guardar_cache_midia(chave, texto)
+            return texto
+        return "[Nao foi possivel transcrever o audio]"
+    except ArquivoGrandeDemais:
+        return f"[Audio muito grande para transcrever — limite de {MIDIA_MAX_MB:g} MB]"
     except Exception as e:
         print(f"ERRO ao transcrever audio: {e}")
         return "[Erro ao processar audio]"
@@ -206,18 +1201,16 @@ async def transcrever_audio(url_audio: str) -> str:
 
 async def extrair_texto_pdf(url_arquivo: str) -> str:
     try:
-        import pdfplumber
-        async with httpx.AsyncClient(timeout=60) as http:
-            r_arquivo = await http.get(url_arquivo)
-            conteudo = r_arquivo.content
-        with pdfplumber.open(io.BytesIO(conteudo)) as pdf:
-            paginas = []
-            for i, pagina in enumerate(pdf.pages[:20]):
-                texto = pagina.extract_text()
-                if texto:
-                    paginas.append(f"[Pagina {i+1}]\n{texto}")
-        texto_completo = "\n\n".join(paginas)
-        return f"[Conteudo do PDF enviado pelo usuario]:\n{texto_completo[:8000]}"
+        conteudo = await baixar_midia(url_arquivo)
+        chave = chave_cache_midia("pdf", conteudo)
+        if texto_cache := await buscar_cache_midia(chave):
+            return texto_cache
+        texto_completo = await extrair_em_processo(_extrair_pdf, conteudo, 20, TEXTO_MIDIA_LIMITE)
+        texto = f"[Conteudo do PDF enviado pelo usuario]:\n{texto_completo}"
+        await guardar_cache_midia(chave, texto)
+        return texto
+    except ArquivoGrandeDemais:
+        return f"[PDF muito grande para ler — limite de {MIDIA_MAX_MB:g} MB]"
     except Exception as e:
         print(f"ERRO ao ler PDF: {e}")
         return "[Nao foi possivel ler o PDF]"
@@ -225,24 +1218,16 @@ async def extrair_texto_pdf(url_arquivo: str) -> str:
 
 async def extrair_texto_excel(url_arquivo: str) -> str:
     try:
-        import openpyxl
-        async with httpx.AsyncClient(timeout=60) as http:
-            r_arquivo = await http.get(url_arquivo)
-            conteudo = r_arquivo.content
-        wb = openpyxl.load_workbook(io.BytesIO(conteudo), read_only=True, data_only=True)
-        linhas_total = []
-        for nome_aba in wb.sheetnames[:3]:
-            ws = wb[nome_aba]
-            linhas_total.append(f"[Aba: {nome_aba}]")
-            for i, row in enumerate(ws.iter_rows(values_only=True)):
-                if i >= 100:
-                    linhas_total.append("... (mais linhas omitidas)")
-                    break
-                linha = " | ".join(str(c) if c is not None else "" for c in row)
-                if linha.strip():
-                    linhas_total.append(linha)
-        texto_completo = "\n".join(linhas_total)
-        return f"[Conteudo da planilha enviada pelo usuario]:\n{texto_completo[:8000]}"
+        conteudo = await baixar_midia(url_arquivo)
+        chave = chave_cache_midia("planilha", conteudo)
+        if texto_cache := await buscar_cache_midia(chave):
+            return texto_cache
+        texto_completo = await extrair_em_processo(_extrair_excel, conteudo, TEXTO_MIDIA_LIMITE)
+        texto = f"[Conteudo da planilha enviada pelo usuario]:\n{texto_completo}"
+        await guardar_cache_midia(chave, texto)
+        return texto
+    except ArquivoGrandeDemais:
+        return f"[Planilha muito grande para ler — limite de {MIDIA_MAX_MB:g} MB]"
     except Exception as e:
         print(f"ERRO ao ler Excel: {e}")
         return "[Nao foi possivel ler a planilha]"
@@ -313,7 +1298,9 @@ a:hover { text-decoration: underline; }
 textarea { width: 100%; padding: 12px; border: 1px solid #ddd; border-radius: 8px; font-size: 14px; font-family: monospace; line-height: 1.6; resize: vertical; min-height: 300px; }
 textarea:focus { outline: none; border-color: #4f46e5; box-shadow: 0 0 0 2px rgba(79,70,229,0.1); }
 input[type=text], input[type=number] { width: 100%; padding: 10px; border: 1px solid #ddd; border-radius: 8px; font-size: 14px; }
+select { padding: 10px; border: 1px solid #ddd; border-radius: 8px; font-size: 14px; background: white; }
 .success { background: #dcfce7; color: #16a34a; padding: 10px 16px; border-radius: 8px; margin-bottom: 16px; font-size: 14px; }
+.erro { background: #fee2e2; color: #dc2626; padding: 10px 16px; border-radius: 8px; margin-bottom: 16px; font-size: 14px; }
 .nav { display: flex; gap: 12px; margin-bottom: 20px; flex-wrap: wrap; }
 .nav a { padding: 8px 16px; border-radius: 8px; background: white; font-size: 14px; box-shadow: 0 1px 3px rgba(0,0,0,0.08); }
 .nav a.ativo { background: #4f46e5; color: white; }
@@ -331,7 +1318,13 @@ def base_html(titulo: str, conteudo: str, pagina_ativa: str = "") -> str:
         "assinaturas": ("Assinaturas", "/admin/assinaturas"),
         "consultas":   ("Consultas",   "/admin/consultas"),
         "prompt":      ("Prompt",      "/admin/prompt"),
+        "respostas":   ("Respostas",   "/admin/respostas"),
         "arquivos":    ("Arquivos",    "/admin/arquivos"),
+        "fila":        ("Fila",        "/admin/fila"),
+        "envios":      ("Envios",      "/admin/envios"),
+        "cache":       ("Cache",       "/admin/cache"),
+        "modelos":     ("Modelos",     "/admin/modelos"),
+        "metricas":    ("Metricas",    "/admin/metricas"),
     }
     nav_html = ""
     for chave, (label, url) in nav.items():
@@ -359,21 +1352,577 @@ def base_html(titulo: str, conteudo: str, pagina_ativa: str = "") -> str:
 </body>
 </html>"""
 
+# ============================================================
+# CLAUDE — CONCORRENCIA E LIMITE DE TAXA
+# ============================================================
+
+class BaldeDeTokens:
+    """Token bucket: libera `por_minuto` requisicoes por minuto, com rajada de ate 10s de cota."""
+
+    def __init__(self, por_minuto: float):
+        self.taxa       = por_minuto / 60
+        self.capacidade = max(1.0, self.taxa * 10)
+        self.tokens     = self.capacidade
+        self.atualizado = time.monotonic()
+        self.lock       = asyncio.Lock()
+
+    async def aguardar(self):
+        async with self.lock:
+            while True:
+                agora = time.monotonic()
+                self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+                self.atualizado = agora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.taxa)
+
+
+def _ler_rpm_modelos(config: str) -> dict:
+    limites = {}
+    for item in config.split(","):
+        modelo, _, rpm = item.partition("=")
+        if modelo.strip() and rpm.strip():
+            limites[modelo.strip()] = float(rpm)
+    return limites
+
+llm_semaforo = asyncio.Semaphore(LLM_CONCORRENCIA)
+_rpm_modelos = _ler_rpm_modelos(LLM_RPM_MODELOS)
+_baldes: dict = {}
+latencias_llm: dict = {}  # modelo -> ultimas latencias (s), em memoria como as metricas HTTP
+latencias_recentes_llm: dict = {}  # modelo -> (instante, latencia) das chamadas recentes, para o roteador
+
+def obter_balde(modelo: str) -> BaldeDeTokens | None:
+    rpm = _rpm_modelos.get(modelo, LLM_RPM)
+    if rpm <= 0:
+        return None
+    if modelo not in _baldes:
+        _baldes[modelo] = BaldeDeTokens(rpm)
+    return _baldes[modelo]
+
+
+async def chamar_llm(model: str, system, messages: list, max_tokens: int = 1024, ao_receber_texto=None):
+    """Chama o Claude sem bloquear o event loop, respeitando o limite de taxa do modelo
+    e o limite global de chamadas simultaneas.
+
+    Se `ao_receber_texto` for passado, usa streaming e chama `await ao_receber_texto(trecho)`
+    a cada pedaco de texto gerado. Nos dois modos retorna a mensagem final completa.
+    """
+    balde = obter_balde(model)
+    if balde:
+        await balde.aguardar()
+    async with llm_semaforo:
+        inicio = time.monotonic()
+        if ao_receber_texto is None:
+            resposta = await client.messages.create(
+                model=model,
+                max_tokens=max_tokens,
+                system=system,
+                messages=messages
+            )
+        else:
+            async with client.messages.stream(
+                model=model,
+                max_tokens=max_tokens,
+                system=system,
+                messages=messages
+            ) as stream:
+                async for trecho in stream.text_stream:
+                    await ao_receber_texto(trecho)
+                resposta = await stream.get_final_message()
+        fim = time.monotonic()
+        latencias_llm.setdefault(model, deque(maxlen=500)).append(fim - inicio)
+        latencias_recentes_llm.setdefault(model, deque(maxlen=500)).append((fim, fim - inicio))
+        return resposta
+
+
+def marcar_cache_historico(historico: list, anexo: str = "") -> list:
+    """Coloca um breakpoint de cache na ultima mensagem: no proximo turno a Anthropic le
+    do cache todo o historico ate aqui e so cobra preco cheio pelas mensagens novas.
+    `anexo` vai depois do breakpoint, so neste turno: nao entra no prefixo cacheado."""
+    if not historico:
+        return historico
+    ultima = historico[-1]
+    blocos = [{"type": "text", "text": ultima["content"], "cache_control": {"type": "ephemeral"}}]
+    if anexo:
+        blocos.append({"type": "text", "text": anexo})
+    return historico[:-1] + [{"role": ultima["role"], "content": blocos}]
+
+
+LLM_USO_PREFIX = "metricas:llm:"  # hash por dia com tokens gastos, total e por modelo
+
+async def registrar_uso_llm(modelo: str, usage, pipe=None):
+    """Com `pipe`, so enfileira os comandos — quem chamou executa junto com o resto do lote."""
+    chave  = f"{LLM_USO_PREFIX}{datetime.now():%Y-%m-%d}"
+    campos = {
+        "chamadas": 1,
+        "entrada": usage.input_tokens,
+        "saida": usage.output_tokens,
+        "cache_leitura": usage.cache_read_input_tokens or 0,
+        "cache_escrita": usage.cache_creation_input_tokens or 0,
+    }
+    lote = pipe if pipe is not None else r.pipeline()
+    for campo, valor in campos.items():
+        lote.hincrby(chave, campo, valor)
+        lote.hincrby(chave, f"{modelo}:{campo}", valor)
+    lote.expire(chave, 40 * 86400)
+    if pipe is None:
+        await lote.execute()
+    print(f"CLAUDE {modelo}: {campos['entrada']} entrada, {campos['saida']} saida, "
+          f"cache {campos['cache_leitura']} lidos / {campos['cache_escrita']} gravados")
+
+async def obter_uso_llm(dia: str) -> dict:
+    return {campo: int(valor) for campo, valor in (await r.hgetall(f"{LLM_USO_PREFIX}{dia}")).items()}
+
+def tokens_do_dia(uso: dict, modelo: str) -> int:
+    return sum(uso.get(f"{modelo}:{campo}", 0) for campo in ("entrada", "saida", "cache_leitura", "cache_escrita"))
+
+# ------------------------------------------------------------
+# Roteador: escolhe o modelo de cada turno pelo plano do usuario e pelo tipo de mensagem,
+# e volta para o AGENT_MODEL quando o escolhido esta lento ou estourou o orcamento do dia.
+# Trocar de modelo perde o cache de prompt da Anthropic, por isso a escolha e estavel:
+# a mesma situacao sempre leva ao mesmo modelo.
+# ------------------------------------------------------------
+ORCAMENTO_TOKENS_KEY = "config:orcamento_tokens"  # hash modelo -> tokens por dia (0 ou ausente = sem limite)
+ROTEADOR_METRICAS    = "metricas:roteador"        # hash com quantos turnos foram por cada motivo
+ROTEADOR_AMOSTRAS    = 20                          # chamadas recentes necessarias para confiar no p95
+ROTEADOR_JANELA      = 300                         # segundos; so as chamadas desse periodo contam para o p95
+
+def lento_demais(modelo: str) -> bool:
+    """p95 das chamadas dos ultimos ROTEADOR_JANELA segundos acima do SLO. Quando o modelo deixa
+    de receber trafego, as amostras antigas saem da janela e ele volta a ser escolhido."""
+    if not LLM_SLO_P95:
+        return False
+    limite = time.monotonic() - ROTEADOR_JANELA
+    latencias = [latencia for instante, latencia in latencias_recentes_llm.get(modelo, []) if instante >= limite]
+    return len(latencias) >= ROTEADOR_AMOSTRAS and percentil(latencias, 0.95) > LLM_SLO_P95
+
+def escolher_modelo(mensagem: str, premium: bool, orcamentos: dict, uso: dict) -> tuple[str, str]:
+    """Retorna (modelo, motivo) para o turno."""
+    if any(mensagem.startswith(marca) for marca in MARCAS_MIDIA):
+        modelo, motivo = AGENT_MODEL_COMPLEXO, "midia"
+    elif len(mensagem) >= ROTEADOR_COMPLEXO_CHARS:
+        modelo, motivo = AGENT_MODEL_COMPLEXO, "complexa"
+    elif premium:
+        modelo, motivo = AGENT_MODEL_PREMIUM, "premium"
+    else:
+        modelo, motivo = AGENT_MODEL, "padrao"
+
+    if modelo == AGENT_MODEL:
+        return modelo, motivo
+    if orcamentos.get(modelo) and tokens_do_dia(uso, modelo) >= orcamentos[modelo]:
+        return AGENT_MODEL, "orcamento"
+    if lento_demais(modelo):
+        return AGENT_MODEL, "latencia"
+    return modelo, motivo
+
+async def salvar_orcamento_tokens(modelo: str, tokens: int):
+    if tokens > 0:
+        await r.hset(ORCAMENTO_TOKENS_KEY, modelo, tokens)
+    else:
+        await r.hdel(ORCAMENTO_TOKENS_KEY, modelo)
+
+# ============================================================
+# CONTEXTO — historico dentro de um orcamento de tokens + resumo da parte antiga
+# ============================================================
+RESUMO_CONVERSA_PREFIX = "resumo_conversa:"  # hash por usuario: texto, ate (numero da ultima mensagem resumida), posicao (mensagens ja gravadas)
+MARCAS_MIDIA = ("[Conteudo do PDF enviado pelo usuario]:", "[Conteudo da planilha enviada pelo usuario]:")
+MIDIA_REFERENCIA_CHARS = 300  # quanto do documento fica no historico depois que ele ja foi respondido
+RESUMO_LOTE = 10  # mensagens alem de HISTORICO_LIMITE acumuladas antes de atualizar o resumo (uma chamada a cada ~5 turnos)
+
+_resumos: dict = {}  # telefone -> tarefa atualizando o resumo
+
+def estimar_tokens(texto: str) -> int:
+    # Aproximacao de ~4 caracteres por token; boa o bastante para um orcamento
+    return len(texto) // 4 + 1
+
+def referenciar_midia(conteudo: str) -> str:
+    """Troca o texto extraido de um PDF/planilha por um trecho curto. So e usado em mensagens
+    antigas: o documento completo vai uma vez, no turno em que foi enviado."""
+    for marca in MARCAS_MIDIA:
+        inicio = conteudo.find(marca)
+        if inicio < 0:
+            continue
+        documento = conteudo[inicio + len(marca):].strip()
+        if len(documento) <= MIDIA_REFERENCIA_CHARS:
+            continue
+        return (f"{conteudo[:inicio]}{marca}\n{documento[:MIDIA_REFERENCIA_CHARS]}..."
+                f"\n[documento ja analisado antes; {len(documento) - MIDIA_REFERENCIA_CHARS} caracteres omitidos]")
+    return conteudo
+
+def montar_contexto(historico: list) -> tuple[list, int]:
+    """Pega as mensagens mais recentes que cabem em CONTEXTO_TOKENS (a ultima sempre entra).
+    Retorna (mensagens, quantas do inicio de `historico` ficaram de fora)."""
+    mensagens = [historico[-1]] if historico else []
+    usados = estimar_tokens(mensagens[0]["content"]) if mensagens else 0
+    for msg in reversed(historico[:-1]):
+        msg = {"role": msg["role"], "content": referenciar_midia(msg["content"])}
+        usados += estimar_tokens(msg["content"])
+        if usados > CONTEXTO_TOKENS:
+            break
+        mensagens.insert(0, msg)
+    # A conversa enviada ao Claude precisa comecar pelo usuario
+    while len(mensagens) > 1 and mensagens[0]["role"] != "user":
+        mensagens.pop(0)
+    return mensagens, len(historico) - len(mensagens)
+
+def agendar_resumo(telefone: str, ate: int):
+    """Atualiza o resumo em segundo plano, sem segurar a resposta; uma tarefa por usuario."""
+    if telefone in _resumos:
+        return
+    tarefa = asyncio.create_task(atualizar_resumo_conversa(telefone, ate))
+    _resumos[telefone] = tarefa
+    tarefa.add_done_callback(lambda _: _resumos.pop(telefone, None))
+
+async def atualizar_resumo_conversa(telefone: str, ate: int):
+    """Junta ao resumo as mensagens que sairam da janela (numeros ate `ate`), sem reler as
+    que ja estao resumidas."""
+    try:
+        pipe = r.pipeline()
+        pipe.lrange(f"{HISTORICO_PREFIX}{telefone}", 0, -1)
+        pipe.hgetall(f"{RESUMO_CONVERSA_PREFIX}{telefone}")
+        itens, resumo = await pipe.execute()
+        total    = int(resumo.get("posicao") or len(itens))
+        anterior = int(resumo.get("ate", 0))
+        primeira = total - len(itens) + 1  # numero da mensagem mais antiga ainda guardada
+        novas = [json.loads(item) for numero, item in enumerate(itens, primeira) if anterior < numero <= ate]
+        if not novas:
+            return
+
+        transcricao = "\n".join(
+            f"{'Usuario' if m['role'] == 'user' else AGENT_NAME}: {referenciar_midia(m['content'])[:1500]}"
+            for m in novas
+        )
+        resposta = await chamar_llm(
+            model=RESUMO_MODELO,
+            max_tokens=500,
+            system="Voce resume conversas de atendimento. Escreva em portugues, em ate 12 linhas, "
+                   "mantendo o que importa para continuar o atendimento: quem e o usuario, dados da "
+                   "crianca, preocupacoes, orientacoes ja dadas, combinados e pedidos pendentes.",
+            messages=[{"role": "user", "content":
+                f"RESUMO ATE AGORA:\n{resumo.get('texto') or '(nenhum)'}\n\n"
+                f"MENSAGENS NOVAS:\n{transcricao}\n\nEscreva o resumo atualizado."}],
+        )
+        pipe = r.pipeline()
+        pipe.hset(f"{RESUMO_CONVERSA_PREFIX}{telefone}", mapping={"texto": resposta.content[0].text, "ate": ate})
+        await registrar_uso_llm(RESUMO_MODELO, resposta.usage, pipe)
+        await pipe.execute()
+        print(f"RESUMO {telefone}: mensagens {anterior + 1}-{ate} resumidas")
+    except Exception as e:
+        print(f"ERRO ao resumir conversa de {telefone}: {e}")
+
+# ============================================================
+# INTENCOES — mensagens comuns respondidas com texto pronto, sem chamar o Claude
+# ============================================================
+INTENCOES_KEY        = "config:intencoes"         # lista JSON de regras, editavel no painel
+INTENCOES_METRICAS   = "metricas:intencoes"       # hash: respostas por regra + "ia" (turnos que foram ao Claude)
+INTENCOES_VERSAO_KEY = "config:intencoes_versao"  # incrementada quando as regras mudam (o prompt nao e recompilado)
+
+# Cada regra casa quando a mensagem contem uma das `palavras`. So responde com o texto pronto se
+# a mensagem tiver ate `max_palavras` palavras; mais longa, segue para o Claude. Com `mensagem_inteira`,
+# a mensagem precisa ser feita so das palavras da regra ("oi, tudo bem?" sim, "oi ele nao dorme" nao);
+# com `primeiro_turno`, so vale quando a conversa ainda nao tem historico.
+# A regra "consulta" so responde quando o interesse e registrado neste turno.
+REGRAS_PADRAO = [
+    {"nome": "consulta", "ativa": True, "max_palavras": 10, "mensagem_inteira": False, "primeiro_turno": False,
+     "palavras": ["marcar uma consulta", "marcar consulta", "agendar uma consulta", "agendar consulta",
+                  "quero uma consulta", "quero consulta", "marcar uma teleconsulta", "agendar uma teleconsulta",
+                  "quero uma teleconsulta", "quero teleconsulta"],
+     "resposta": "Que bom que voce quer uma consulta! 💙 Ja registrei seu interesse e nossa equipe vai "
+                 "entrar em contato por aqui para combinar o horario. Pode me dizer seu nome?",
+     "resposta_premium": ""},
+    {"nome": "pagamento", "ativa": True, "max_palavras": 12, "mensagem_inteira": False, "primeiro_turno": False,
+     "palavras": ["link de pagamento", "link do pagamento", "quero assinar", "como assino", "como assinar",
+                  "assinar o premium", "quero o premium", "virar premium", "pagar a assinatura"],
+     "resposta": "Aqui esta o link para assinar o Premium 💙\n{LINK_PAGAMENTO}\n\nAssim que o pagamento "
+                 "for aprovado, seu acesso e liberado automaticamente por aqui.",
+     "resposta_premium": "Voce ja e Premium 🎉 Pode me contar o que esta acontecendo que eu te ajudo!"},
+    {"nome": "saudacao", "ativa": True, "max_palavras": 4, "mensagem_inteira": True, "primeiro_turno": True,
+     "palavras": ["oi", "ola", "oie", "bom dia", "boa tarde", "boa noite", "tudo bem", "e ai", "hey"],
+     "resposta": "Oi! Aqui e {NOME_AGENTE} 💙 Me conta: como posso te ajudar hoje?",
+     "resposta_premium": ""},
+]
+
+# Regras compiladas em uma unica regex (um grupo por regra), refeita quando a versao muda
+_intencoes_compiladas = {"versao": None, "regras": [], "regex": None}
+
+async def obter_regras_intencao() -> list:
+    regras = await r.get(INTENCOES_KEY)
+    if not regras:
+        return [dict(regra) for regra in REGRAS_PADRAO]
+    # Regras salvas antes de um campo existir herdam o valor da regra padrao de mesmo nome
+    padrao = {regra["nome"]: regra for regra in REGRAS_PADRAO}
+    return [{**{campo: valor for campo, valor in padrao.get(regra["nome"], {}).items() if campo in ("mensagem_inteira", "primeiro_turno")}, **regra}
+            for regra in json.loads(regras)]
+
+async def salvar_regras_intencao(regras: list):
+    pipe = r.pipeline()
+    pipe.set(INTENCOES_KEY, json.dumps(regras))
+    pipe.incr(INTENCOES_VERSAO_KEY)
+    await pipe.execute()
+
+def compilar_regras_intencao(regras: list):
+    grupos = []
+    for i, regra in enumerate(regras):
+        palavras = [normalizar_texto(p) for p in regra.get("palavras", []) if normalizar_texto(p)]
+        if regra.get("ativa") and palavras:
+            # Mais longas primeiro, para "bom dia" ganhar de um eventual "bom"
+            alternativas = "|".join(re.escape(p) for p in sorted(palavras, key=len, reverse=True))
+            grupos.append(f"(?P<r{i}>\\b(?:{alternativas})\\b)")
+    return re.compile("|".join(grupos)) if grupos else None
+
+async def obter_intencoes_compiladas(versao: str | None) -> dict:
+    versao = versao or "0"
+    if versao != _intencoes_compiladas["versao"]:
+        regras = await obter_regras_intencao()
+        _intencoes_compiladas.update(versao=versao, regras=regras, regex=compilar_regras_intencao(regras))
+    return _intencoes_compiladas
+
+def classificar_intencao(mensagem: str, compiladas: dict) -> dict | None:
+    """Regra que casa com a mensagem; se varias casarem, vale a que vem primeiro na lista."""
+    if not compiladas["regex"]:
+        return None
+    casadas = {int(nome[1:]) for m in compiladas["regex"].finditer(normalizar_texto(mensagem))
+               for nome, valor in m.groupdict().items() if valor}
+    return compiladas["regras"][min(casadas)] if casadas else None
+
+def resposta_pronta(regra: dict, mensagem: str, premium: bool, link_pg: str, primeiro_turno: bool) -> str | None:
+    """Texto pronto da regra para esta mensagem, ou None se ela deve ir para o Claude."""
+    normalizada = normalizar_texto(mensagem)
+    if len(normalizada.split()) > int(regra.get("max_palavras", 8)):
+        return None
+    if regra.get("primeiro_turno") and not primeiro_turno:
+        return None
+    if regra.get("mensagem_inteira"):
+        alternativas = "|".join(re.escape(normalizar_texto(p)) for p in regra.get("palavras", []) if normalizar_texto(p))
+        if not alternativas or not re.fullmatch(f"(?:{alternativas})(?: (?:{alternativas}))*", normalizada):
+            return None
+    texto = (premium and regra.get("resposta_premium")) or regra.get("resposta")
+    if not texto:
+        return None
+    return texto.replace("{NOME_AGENTE}", AGENT_NAME).replace("{LINK_PAGAMENTO}", link_pg)
+
+# ============================================================
+# CACHE DE RESPOSTAS — mesma pergunta, sem contexto, mesma resposta
+# ============================================================
+# So entram mensagens que chegam sem historico (primeira mensagem ou conversa apagada):
+# a resposta depende apenas do texto, da versao do prompt e do STATUS do usuario.
+CACHE_RESPOSTA_PREFIX   = "cache:resposta:"
+CACHE_RESPOSTA_IDX      = "cache:resposta:idx"      # zset chave -> ultimo uso (timestamp)
+CACHE_RESPOSTA_METRICAS = "metricas:cache_respostas"  # hash com acertos/falhas
+
+def chave_cache_resposta(mensagem: str, prompt_versao: str | None, status: str) -> str | None:
+    pergunta = normalizar_texto(mensagem)
+    if not pergunta or any(mensagem.startswith(marca) for marca in MARCAS_MIDIA):
+        return None
+    return f"{CACHE_RESPOSTA_PREFIX}{hashlib.sha256(f'{prompt_versao or 0}:{status}:{pergunta}'.encode()).hexdigest()}"
+
+async def buscar_cache_resposta(chave: str) -> str | None:
+    return await r.hget(chave, "resposta")
+
+def usar_cache_resposta(chave: str, pipe):
+    """Conta o acerto e marca o uso para o LRU, no pipeline que grava a resposta."""
+    pipe.zadd(CACHE_RESPOSTA_IDX, {chave: time.time()}, xx=True)
+    pipe.hincrby(chave, "acertos", 1)
+    pipe.hincrby(CACHE_RESPOSTA_METRICAS, "acertos", 1)
+
+def guardar_cache_resposta(chave: str, mensagem: str, status: str, resposta: str, link_pg: str, pipe):
+    if link_pg:
+        resposta = resposta.replace(link_pg, "{LINK_PAGAMENTO}")
+    pipe.hset(chave, mapping={
+        "pergunta": mensagem[:500],
+        "status": status,
+        "resposta": resposta,
+        "acertos": 0,
+        "criado": datetime.now().strftime("%d/%m/%Y %H:%M"),
+    })
+    pipe.expire(chave, int(RESPOSTAS_CACHE_HORAS * 3600))
+    pipe.zadd(CACHE_RESPOSTA_IDX, {chave: time.time()})
+
+async def aplicar_limites_cache_respostas():
+    """Passando de RESPOSTAS_CACHE_MAX, remove as usadas ha mais tempo. As vencidas pelo TTL
+    deixam de ser usadas, vao para o fim do indice e saem primeiro."""
+    excesso = await r.zcard(CACHE_RESPOSTA_IDX) - RESPOSTAS_CACHE_MAX
+    if excesso <= 0:
+        return
+    remover = await r.zrange(CACHE_RESPOSTA_IDX, 0, excesso - 1)
+    pipe = r.pipeline()
+    pipe.delete(*remover)
+    pipe.zrem(CACHE_RESPOSTA_IDX, *remover)
+    await pipe.execute()
+
+async def listar_cache_respostas(limite: int = 100) -> list:
+    """Entradas usadas mais recentemente; as que ja venceram saem do indice aqui."""
+    chaves = await r.zrevrange(CACHE_RESPOSTA_IDX, 0, limite - 1)
+    pipe = r.pipeline(transaction=False)
+    for chave in chaves:
+        pipe.hgetall(chave)
+    entradas = await pipe.execute() if chaves else []
+    vencidas = [chave for chave, entrada in zip(chaves, entradas) if not entrada]
+    if vencidas:
+        await r.zrem(CACHE_RESPOSTA_IDX, *vencidas)
+    return [{"chave": chave.removeprefix(CACHE_RESPOSTA_PREFIX), **entrada} for chave, entrada in zip(chaves, entradas) if entrada]
+
+async def limpar_cache_respostas(chave: str | None = None):
+    chaves = [f"{CACHE_RESPOSTA_PREFIX}{chave}"] if chave else await r.zrange(CACHE_RESPOSTA_IDX, 0, -1)
+    if chaves:
+        pipe = r.pipeline()
+        pipe.delete(*chaves)
+        pipe.zrem(CACHE_RESPOSTA_IDX, *chaves)
+        await pipe.execute()
+
+async def resumo_cache_respostas() -> dict:
+    pipe = r.pipeline()
+    pipe.hgetall(CACHE_RESPOSTA_METRICAS)
+    pipe.zcard(CACHE_RESPOSTA_IDX)
+    contadores, entradas = await pipe.execute()
+    acertos, falhas = int(contadores.get("acertos", 0)), int(contadores.get("falhas", 0))
+    return {
+        "acertos": acertos,
+        "falhas": falhas,
+        "taxa": round(100 * acertos / (acertos + falhas), 1) if acertos + falhas else 0,
+        "entradas": entradas,
+    }
+
 # ============================================================
 # FUNCOES AUXILIARES
 # ============================================================
 
-async def enviar_whatsapp(telefone: str, mensagem: str):
+async def postar_whatsapp(telefone: str, mensagem: str, digitando: int = 0) -> httpx.Response:
+    """`digitando`: segundos mostrando "digitando..." no WhatsApp do usuario antes da mensagem."""
     numero_limpo = telefone.replace("+", "").replace("-", "").replace(" ", "")
     if numero_limpo.startswith("55") and len(numero_limpo) == 12:
         numero_limpo = numero_limpo[:4] + "9" + numero_limpo[4:]
     url     = f"https://api.z-api.io/instances/{ZAPI_INSTANCE_ID}/token/{ZAPI_TOKEN}/send-text"
     headers = {"Content-Type": "application/json", "Client-Token": ZAPI_CLIENT_TOKEN}
     payload = {"phone": numero_limpo, "message": mensagem}
+    if digitando:
+        payload["delayTyping"] = digitando
     print(f"ENVIANDO para {numero_limpo}")
-    async with httpx.AsyncClient(timeout=30) as http:
-        response = await http.post(url, headers=headers, json=payload)
-        print(f"Z-API STATUS: {response.status_code} | {response.text}")
+    response = await requisitar("zapi", "POST", url, headers=headers, json=payload)
+    print(f"Z-API STATUS: {response.status_code} | {response.text}")
+    return response
+
+# ------------------------------------------------------------
+# Fila de envio: respostas, avisos e cobrancas passam por aqui. Cada telefone cai sempre na
+# mesma fila, entao as mensagens chegam na ordem; o balde segura o ritmo abaixo do limite da Z-API.
+# ------------------------------------------------------------
+ENVIO_PREFIX      = "envio:"            # hash por mensagem: telefone, status, tentativas, erro
+ENVIO_RECENTES    = "envio:recentes"    # ids dos ultimos envios, para o painel
+ENVIO_METRICAS    = "metricas:envio"    # hash: enfileiradas, entregues, falhas, novas_tentativas
+ENVIO_RETOMAR     = "envio:retomar"     # ids que ficaram sem entregar ao desligar; o proximo start entrega
+
+filas_envio: list = [asyncio.Queue() for _ in range(max(ENVIO_WORKERS, 1))]
+balde_zapi = BaldeDeTokens(ENVIO_RPM) if ENVIO_RPM > 0 else None
+
+async def enviar_whatsapp(telefone: str, mensagem: str, digitando: int = 0) -> str:
+    """Enfileira a mensagem e retorna o id do envio; a entrega acontece em worker_envio."""
+    id_envio = secrets.token_hex(8)
+    pipe = r.pipeline()
+    pipe.hset(f"{ENVIO_PREFIX}{id_envio}", mapping={
+        "telefone": telefone,
+        "status": "na_fila",
+        "tentativas": 0,
+        "criado": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+        "previa": mensagem[:80],
+        "mensagem": mensagem,
+        "digitando": digitando,
+    })
+    pipe.expire(f"{ENVIO_PREFIX}{id_envio}", int(ENVIO_STATUS_HORAS * 3600))
+    pipe.lpush(ENVIO_RECENTES, id_envio)
+    pipe.ltrim(ENVIO_RECENTES, 0, 99)
+    pipe.hincrby(ENVIO_METRICAS, "enfileiradas", 1)
+    await pipe.execute()
+    enfileirar_envio({"id": id_envio, "telefone": telefone, "mensagem": mensagem, "digitando": digitando})
+    return id_envio
+
+def enfileirar_envio(envio: dict):
+    filas_envio[int(hashlib.md5(envio["telefone"].encode()).hexdigest(), 16) % len(filas_envio)].put_nowait(envio)
+
+async def guardar_envios_pendentes() -> int:
+    """Ao desligar: o que ainda esta nas filas vai para ENVIO_RETOMAR, na ordem, para o
+    proximo start entregar. Os que estavam no meio da entrega ja foram guardados pelo worker."""
+    ids = []
+    for fila in filas_envio:
+        while not fila.empty():
+            ids.append(fila.get_nowait()["id"])
+            fila.task_done()
+    if ids:
+        await r.rpush(ENVIO_RETOMAR, *ids)
+    return len(ids)
+
+async def retomar_envios() -> int:
+    """Ao subir: devolve para as filas os envios guardados no ultimo desligamento.
+    LPOP tira cada id uma vez so, mesmo com varias instancias subindo juntas."""
+    retomados = 0
+    while id_envio := await r.lpop(ENVIO_RETOMAR):
+        dados = await r.hgetall(f"{ENVIO_PREFIX}{id_envio}")
+        if "mensagem" not in dados:
+            continue  # status ja expirou; nao ha o que enviar
+        enfileirar_envio({"id": id_envio, "telefone": dados["telefone"], "mensagem": dados["mensagem"],
+                          "digitando": int(dados.get("digitando") or 0)})
+        retomados += 1
+    if retomados:
+        print(f"ENVIO: {retomados} mensagens do ultimo desligamento de volta na fila")
+    return retomados
+
+async def entregar_envio(envio: dict):
+    """Tenta ate ENVIO_TENTATIVAS vezes, com espera exponencial e aleatoria entre elas.
+    Erros 4xx (fora 429) nao mudam com nova tentativa e viram falha na hora."""
+    chave = f"{ENVIO_PREFIX}{envio['id']}"
+    erro = ""
+    for tentativa in range(1, ENVIO_TENTATIVAS + 1):
+        if balde_zapi:
+            await balde_zapi.aguardar()
+        try:
+            resposta = await postar_whatsapp(envio["telefone"], envio["mensagem"], envio.get("digitando", 0))
+            if resposta.is_success:
+                envio["entregue"] = True
+                pipe = r.pipeline()
+                pipe.hset(chave, mapping={"status": "entregue", "tentativas": tentativa, "entregue": datetime.now().strftime("%d/%m/%Y %H:%M:%S")})
+                pipe.hincrby(ENVIO_METRICAS, "entregues", 1)
+                await pipe.execute()
+                return
+            erro = f"HTTP {resposta.status_code}: {resposta.text[:200]}"
+            definitivo = 400 <= resposta.status_code < 500 and resposta.status_code != 429
+        except Exception as e:
+            erro, definitivo = str(e) or type(e).__name__, False
+        if definitivo or tentativa == ENVIO_TENTATIVAS:
+            break
+        pipe = r.pipeline()
+        pipe.hset(chave, mapping={"status": "tentando", "tentativas": tentativa, "erro": erro})
+        pipe.hincrby(ENVIO_METRICAS, "novas_tentativas", 1)
+        await pipe.execute()
+        await asyncio.sleep(FILA_BACKOFF * 2 ** (tentativa - 1) * random.uniform(0.5, 1.5))
+
+    print(f"ENVIO FALHOU para {envio['telefone']}: {erro}")
+    pipe = r.pipeline()
+    pipe.hset(chave, mapping={"status": "falhou", "tentativas": tentativa, "erro": erro})
+    pipe.hincrby(ENVIO_METRICAS, "falhas", 1)
+    await pipe.execute()
+
+async def worker_envio(fila: asyncio.Queue):
+    while True:
+        envio = await fila.get()
+        try:
+            await entregar_envio(envio)
+        except asyncio.CancelledError:
+            # Desligando no meio da entrega (ou da espera entre tentativas): fica para o proximo start
+            if not envio.get("entregue"):
+                await r.rpush(ENVIO_RETOMAR, envio["id"])
+            raise
+        except Exception as e:
+            print(f"ERRO no envio para {envio['telefone']}: {e}")
+        finally:
+            fila.task_done()
+
+async def listar_envios_recentes() -> list:
+    ids = await r.lrange(ENVIO_RECENTES, 0, -1)
+    pipe = r.pipeline(transaction=False)
+    for id_envio in ids:
+        pipe.hgetall(f"{ENVIO_PREFIX}{id_envio}")
+    envios = await pipe.execute() if ids else []
+    return [{"id": id_envio, **envio} for id_envio, envio in zip(ids, envios) if envio]
 
 
 def obter_link_pagamento(telefone: str) -> str:
@@ -384,60 +1933,374 @@ def obter_link_pagamento(telefone: str) -> str:
     return f"https://www.mercadopago.com.br/subscriptions/checkout?preapproval_plan_id={MP_PLAN_ID}&back_url={BASE_URL}/pagamento/obrigado&external_reference={telefone}"
 
 
-async def chamar_claude(telefone: str, mensagem_usuario: str) -> str:
-    # Detecta interesse em consulta na mensagem
-    palavras_consulta = ["consulta", "agendar", "teleconsulta", "atendimento", "marcar"]
-    if any(p in mensagem_usuario.lower() for p in palavras_consulta):
-        # Verifica se ja tem nome registrado para consulta
-        dados_consulta = r.get(f"{CONSULTA_PREFIX}{telefone}")
-        if not dados_consulta:
-            # Registra com nome desconhecido por enquanto, sera atualizado
-            registrar_interesse_consulta(telefone, "Nome nao informado")
-            print(f"INTERESSE CONSULTA registrado: {telefone}")
-
-    salvar_mensagem(telefone, "user", mensagem_usuario)
-    historico = obter_historico(telefone)
+async def chamar_claude(telefone: str, mensagem_usuario: str, ao_receber_texto=None,
+                        id_turno: str | None = None, repetido: bool = False) -> str:
+    # Uma ida ao Redis para gravar a mensagem e ler o turno, outra para gravar a resposta
+    # (mais duas so quando o prompt mudou e precisa ser recompilado)
+    turno     = await carregar_turno(telefone, mensagem_usuario, id_turno, repetido)
+
+    # A janela vai alem das HISTORICO_LIMITE mensagens enquanto houver mensagens ainda nao
+    # resumidas (ate RESUMO_LOTE a mais, se couberem nos tokens): nada fica fora das duas.
+    # O resumo anda em lotes — resumir a cada turno dobraria as chamadas ao Claude — e,
+    # de quebra, o inicio da janela so muda quando o resumo avanca
+    total = turno["total_msgs"]
+    ate   = int(turno["resumo"].get("ate", 0))
+    historico, _ = montar_contexto(turno["historico"][-max(HISTORICO_LIMITE, total - ate):])
+    ultima_fora   = total - len(historico)   # ultima mensagem que nao foi ao Claude
+    ultima_normal = total - HISTORICO_LIMITE  # ultima antes da janela normal
+    # Uma de folga: a janela pode perder a resposta do assistente para comecar pelo usuario.
+    # Se foi o orcamento de tokens que cortou, o resumo ja cobre RESUMO_LOTE mensagens que ainda
+    # estao na janela, para nao virar uma chamada por turno
+    if ultima_fora > ate + 1:
+        agendar_resumo(telefone, min(ultima_fora + RESUMO_LOTE, total - 1))
+    elif ultima_normal - ate >= RESUMO_LOTE:
+        agendar_resumo(telefone, ultima_normal)
+    resumo = f"\nRESUMO DA CONVERSA ANTERIOR:\n{turno['resumo']['texto']}" if turno["resumo"].get("texto") else ""
 
     hoje       = datetime.now().strftime("%d/%m/%Y")
     dia_semana = ["segunda-feira","terca-feira","quarta-feira","quinta-feira",
                   "sexta-feira","sabado","domingo"][datetime.now().weekday()]
 
     # Injeta status de assinatura no prompt
-    status_usuario = "PREMIUM" if eh_premium(telefone) else "FREEMIUM"
+    status_usuario = "PREMIUM" if turno["premium"] else "FREEMIUM"
     link_pg = obter_link_pagamento(telefone)
 
-    prompt_base = injetar_arquivos_no_prompt(obter_prompt())
-    prompt_base = prompt_base.replace("{STATUS}", status_usuario)
-    prompt_base = prompt_base.replace("[LINK_PAGAMENTO]", link_pg)
-
-    system = prompt_base + f"\n\nDATA ATUAL: {dia_semana}, {hoje}\nSTATUS DO USUARIO: {status_usuario}\nLINK DE PAGAMENTO: {link_pg}"
-
-    resposta = client.messages.create(
-        model=AGENT_MODEL,
+    # Detecta interesse em consulta na mensagem
+    palavras_consulta = ["consulta", "agendar", "teleconsulta", "atendimento", "marcar"]
+    registrar_consulta = any(p in mensagem_usuario.lower() for p in palavras_consulta) and not turno["tem_consulta"]
+
+    # Intencoes comuns (saudacao, link de pagamento, pedido de consulta) tem resposta pronta.
+    # A de consulta diz que registrou o interesse, entao so vale quando ele e registrado agora.
+    regra = classificar_intencao(mensagem_usuario, await obter_intencoes_compiladas(turno["intencoes_versao"]))
+    if regra and regra["nome"] == "consulta" and not registrar_consulta:
+        regra = None
+    primeiro_turno = len(turno["historico"]) == 1 and not turno["resumo"].get("texto")
+    if regra and (texto_resposta := resposta_pronta(regra, mensagem_usuario, turno["premium"], link_pg, primeiro_turno)):
+        pipe = r.pipeline()
+        await salvar_mensagem(telefone, "assistant", texto_resposta, pipe)
+        pipe.hincrby(INTENCOES_METRICAS, regra["nome"], 1)
+        if registrar_consulta:
+            await registrar_interesse_consulta(telefone, "Nome nao informado", pipe)
+        await pipe.execute()
+        print(f"INTENCAO {telefone}: {regra['nome']} respondida sem IA")
+        return texto_resposta
+
+    # Pergunta sem contexto ja respondida antes para o mesmo STATUS: devolve a mesma resposta
+    chave_cache = None
+    if RESPOSTAS_CACHE and primeiro_turno:
+        chave_cache = chave_cache_resposta(mensagem_usuario, turno["prompt_versao"], status_usuario)
+    if chave_cache and (guardada := await buscar_cache_resposta(chave_cache)):
+        texto_resposta = guardada.replace("{LINK_PAGAMENTO}", link_pg)
+        pipe = r.pipeline()
+        await salvar_mensagem(telefone, "assistant", texto_resposta, pipe)
+        usar_cache_resposta(chave_cache, pipe)
+        if registrar_consulta:
+            await registrar_interesse_consulta(telefone, "Nome nao informado", pipe)
+        await pipe.execute()
+        print(f"CACHE RESPOSTA {telefone}: respondida sem IA")
+        return texto_resposta
+
+    # O bloco fixo (prompt + arquivos) e igual para todos os usuarios de um mesmo STATUS e fica
+    # no cache da Anthropic; o que muda por usuario ou por dia vai num bloco pequeno no final.
+    # Quando o link e por usuario, o prompt fixo aponta para o link informado na cauda.
+    # Os trechos mudam a cada mensagem: vao junto da mensagem atual, depois do breakpoint do
+    # historico, para nao invalidar o cache do historico a cada turno
+    prompt_fixo = await obter_prompt_compilado(turno["prompt_versao"])
+    trechos     = trechos_relevantes(mensagem_usuario)
+    trechos     = f"TRECHOS DOS ARQUIVOS DE REFERENCIA PARA ESTA MENSAGEM:{trechos}" if trechos else ""
+    prompt_fixo = prompt_fixo.replace("{STATUS}", status_usuario)
+    prompt_fixo = prompt_fixo.replace("[LINK_PAGAMENTO]", LINK_PAGAMENTO or "o LINK DE PAGAMENTO informado no fim destas instrucoes")
+
+    system = [
+        {"type": "text", "text": prompt_fixo, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": f"DATA ATUAL: {dia_semana}, {hoje}\nSTATUS DO USUARIO: {status_usuario}\nLINK DE PAGAMENTO: {link_pg}{resumo}"},
+    ]
+
+    modelo, motivo = escolher_modelo(mensagem_usuario, turno["premium"], turno["orcamentos"], turno["uso"])
+    if motivo in ("orcamento", "latencia"):
+        print(f"ROTEADOR {telefone}: voltando para {modelo} ({motivo})")
+
+    resposta = await chamar_llm(
+        model=modelo,
         max_tokens=1024,
         system=system,
-        messages=historico
+        messages=marcar_cache_historico(historico, trechos),
+        ao_receber_texto=ao_receber_texto
     )
 
     texto_resposta = resposta.content[0].text
-    salvar_mensagem(telefone, "assistant", texto_resposta)
+    pipe = r.pipeline()
+    await salvar_mensagem(telefone, "assistant", texto_resposta, pipe)
+    await registrar_uso_llm(modelo, resposta.usage, pipe)
+    pipe.hincrby(INTENCOES_METRICAS, "ia", 1)
+    pipe.hincrby(ROTEADOR_METRICAS, motivo, 1)
+
+    if registrar_consulta:
+        # Registra com nome desconhecido por enquanto, sera atualizado
+        await registrar_interesse_consulta(telefone, "Nome nao informado", pipe)
+        print(f"INTERESSE CONSULTA registrado: {telefone}")
 
     # Detecta se o bot mencionou interesse em consulta na resposta
-    if "registrar seu interesse" in texto_resposta.lower() or "vou registrar" in texto_resposta.lower():
+    registrou = "registrar seu interesse" in texto_resposta.lower() or "vou registrar" in texto_resposta.lower()
+    if registrou:
         # Tenta extrair nome da ultima mensagem do usuario
-        registrar_interesse_consulta(telefone, mensagem_usuario[:50])
+        await registrar_interesse_consulta(telefone, mensagem_usuario[:50], pipe)
+
+    # Resposta que registrou consulta tem efeito alem do texto e nao e reaproveitada
+    if chave_cache:
+        pipe.hincrby(CACHE_RESPOSTA_METRICAS, "falhas", 1)
+        if not registrou:
+            guardar_cache_resposta(chave_cache, mensagem_usuario, status_usuario, texto_resposta, link_pg, pipe)
 
+    await pipe.execute()
+    if chave_cache and not registrou:
+        await aplicar_limites_cache_respostas()
     return texto_resposta
 
+# ============================================================
+# FILA DE PROCESSAMENTO — webhook responde na hora, workers processam
+# ============================================================
+FILA_FALHAS_KEY    = "fila:falhas"
+FILA_FALHAS_LIMITE = 200
+FILA_RETOMAR_KEY   = "fila:retomar"  # jobs que nao terminaram ao desligar; o proximo start processa
+
+fila_entrada: asyncio.Queue = asyncio.Queue(maxsize=FILA_TAMANHO)
+_reenvios: dict = {}     # tarefa de nova tentativa -> job que ela vai devolver a fila
+_pendentes: dict = {}    # telefone -> mensagens recebidas dentro da janela de agrupamento
+_janelas: dict = {}      # telefone -> tarefa que fecha a janela
+_travas: dict = {}       # telefone -> [asyncio.Lock, quantos estao usando]
+
+async def registrar_falha_fila(job: dict, erro: str):
+    registro = {
+        "telefone": job.get("telefone", ""),
+        "mensagens": job.get("mensagens", []),
+        "tentativas": job.get("tentativas", 0),
+        "id": job.get("id", ""),
+        "erro": erro[:300],
+        "data": datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    }
+    pipe = r.pipeline()
+    pipe.lpush(FILA_FALHAS_KEY, json.dumps(registro))
+    pipe.ltrim(FILA_FALHAS_KEY, 0, FILA_FALHAS_LIMITE - 1)
+    await pipe.execute()
+
+async def listar_falhas_fila() -> list:
+    return [json.loads(item) for item in await r.lrange(FILA_FALHAS_KEY, 0, -1)]
+
+async def enfileirar_mensagens(telefone: str, mensagens: list, id_job: str = "") -> bool:
+    """`id_job` so e passado ao reprocessar uma falha: o job volta com o mesmo id e nao
+    grava de novo a mensagem do usuario se ela ja estiver no historico."""
+    job = {"id": id_job or secrets.token_hex(8), "telefone": telefone, "mensagens": mensagens,
+           "tentativas": 0, "repetido": bool(id_job)}
+    try:
+        fila_entrada.put_nowait(job)
+        return True
+    except asyncio.QueueFull:
+        print(f"FILA CHEIA: mensagens de {telefone} enviadas para a lista de falhas")
+        await registrar_falha_fila(job, "fila cheia")
+        return False
+
+
+async def guardar_jobs_pendentes() -> int:
+    """Ao desligar: jobs esperando nova tentativa e os que ficaram na fila vao para
+    FILA_RETOMAR_KEY. O webhook ja respondeu e marcou o messageId como visto, entao a Z-API
+    nao reenvia; sem isso, a mensagem se perderia no deploy. Os jobs interrompidos no meio
+    do processamento ja foram guardados pelo worker."""
+    jobs = list(_reenvios.values())
+    for tarefa in list(_reenvios):
+        tarefa.cancel()
+    while not fila_entrada.empty():
+        jobs.append(fila_entrada.get_nowait())
+        fila_entrada.task_done()
+    if jobs:
+        await r.rpush(FILA_RETOMAR_KEY, *[json.dumps(job) for job in jobs])
+    return len(jobs)
+
+async def retomar_mensagens() -> int:
+    """Ao subir: devolve para a fila os jobs guardados no ultimo desligamento.
+    LPOP tira cada job uma vez so, mesmo com varias instancias subindo juntas."""
+    retomados = 0
+    while bruto := await r.lpop(FILA_RETOMAR_KEY):
+        job = json.loads(bruto)
+        try:
+            fila_entrada.put_nowait(job)
+            retomados += 1
+        except asyncio.QueueFull:
+            await registrar_falha_fila(job, "fila cheia ao retomar")
+    if retomados:
+        print(f"FILA: {retomados} turnos do ultimo desligamento de volta na fila")
+    return retomados
+
+
+async def _fechar_janela(telefone: str):
+    await asyncio.sleep(AGRUPAR_SEGUNDOS)
+    _janelas.pop(telefone, None)
+    mensagens = _pendentes.pop(telefone, [])
+    if mensagens:
+        await enfileirar_mensagens(telefone, mensagens)
+
+
+async def receber_mensagem(telefone: str, dados: dict):
+    """Guarda a mensagem na janela do telefone. Tudo que chegar ate a janela fechar
+    (AGRUPAR_SEGUNDOS apos a primeira mensagem) vira um unico turno para o Claude."""
+    if AGRUPAR_SEGUNDOS <= 0:
+        await enfileirar_mensagens(telefone, [dados])
+        return
+    _pendentes.setdefault(telefone, []).append(dados)
+    if telefone not in _janelas:
+        _janelas[telefone] = asyncio.create_task(_fechar_janela(telefone))
+
+
+@asynccontextmanager
+async def trava_telefone(telefone: str):
+    """Garante que as mensagens de um mesmo telefone sejam processadas uma de cada vez,
+    na ordem em que sairam da fila — o historico nunca e lido e gravado em paralelo."""
+    entrada = _travas.setdefault(telefone, [asyncio.Lock(), 0])
+    entrada[1] += 1
+    try:
+        async with entrada[0]:
+            yield
+    finally:
+        entrada[1] -= 1
+        if entrada[1] == 0:
+            del _travas[telefone]
+
+
+async def processar_mensagens(telefone: str, mensagens: list, id_turno: str | None = None, repetido: bool = False):
+    textos = []
+    for dados in mensagens:
+        texto = await processar_midia(dados) or dados.get("text", {}).get("message", "")
+        if texto:
+            textos.append(texto)
+    if not textos:
+        return
+    texto = "\n".join(textos)
+    print(f"MSG de {telefone} ({len(textos)} agrupadas): {texto[:80]}")
+    if not ENVIO_EM_PARTES:
+        with medir_round_trips() as round_trips:
+            resposta = await chamar_claude(telefone, texto, id_turno=id_turno, repetido=repetido)
+        print(f"TURNO {telefone}: {round_trips[0]} idas ao Redis")
+        await enviar_whatsapp(telefone, resposta)
+        return
+
+    divisor = DivisorDeResposta(telefone)
+    try:
+        with medir_round_trips() as round_trips:
+            resposta = await chamar_claude(telefone, texto, divisor.receber, id_turno, repetido)
+    except Exception as e:
+        # Parte da resposta ja chegou ao usuario: repetir o turno duplicaria o que foi enviado
+        if divisor.partes:
+            print(f"ERRO {telefone}: resposta interrompida apos {divisor.partes} partes: {e}")
+            return
+        raise
+    if divisor.partes or divisor.buffer:
+        await divisor.finalizar()
+    else:
+        # Resposta pronta ou do cache: nao veio do streaming, vai inteira numa mensagem so
+        await enviar_whatsapp(telefone, resposta)
+    print(f"TURNO {telefone}: {round_trips[0]} idas ao Redis, {divisor.partes or 1} partes")
+
+
+class DivisorDeResposta:
+    """Recebe o texto do streaming e manda cada paragrafo para a fila de envio assim que ele
+    fecha. A primeira parte sai no primeiro fim de frase; as seguintes, se o paragrafo passar
+    de ENVIO_PARTE_MIN caracteres, no ultimo fim de frase disponivel."""
+
+    # Ponto depois de letra (nao de numero, para nao cortar listas "1. ") seguido de espaco
+    FIM_DE_FRASE = re.compile(r'(?<=[^\d\s])[.!?…](?=\s)')
+
+    def __init__(self, telefone: str):
+        self.telefone = telefone
+        self.buffer   = ""
+        self.partes   = 0
+
+    async def receber(self, trecho: str):
+        self.buffer += trecho
+        while (corte := self._achar_corte()) is not None:
+            parte, self.buffer = self.buffer[:corte], self.buffer[corte:].lstrip()
+            await self._enviar(parte)
+
+    async def finalizar(self):
+        await self._enviar(self.buffer)
+        self.buffer = ""
+
+    def _achar_corte(self) -> int | None:
+        self.buffer = self.buffer.lstrip()
+        paragrafo = self.buffer.find("\n\n")
+        if paragrafo > 0:
+            return paragrafo
+        if self.partes and len(self.buffer) < ENVIO_PARTE_MIN:
+            return None
+        finais = [m.end() for m in self.FIM_DE_FRASE.finditer(self.buffer)]
+        return finais[-1] if finais else None
+
+    async def _enviar(self, parte: str):
+        parte = parte.strip()
+        if not parte:
+            return
+        # Entre uma parte e outra o usuario ve "digitando...", mais tempo para partes maiores
+        digitando = min(3, 1 + len(parte) // 200) if self.partes else 0
+        await enviar_whatsapp(self.telefone, parte, digitando)
+        self.partes += 1
+
+
+async def _reenfileirar(job: dict, espera: float):
+    await asyncio.sleep(espera)
+    await fila_entrada.put(job)
+
+
+async def worker_fila(numero: int):
+    while True:
+        job = await fila_entrada.get()
+        try:
+            async with trava_telefone(job["telefone"]):
+                await processar_mensagens(job["telefone"], job["mensagens"], job["id"], job["repetido"])
+        except asyncio.CancelledError:
+            # Desligando no meio do turno: fica para o proximo start, sem gravar a mensagem de novo
+            job["repetido"] = True
+            await r.rpush(FILA_RETOMAR_KEY, json.dumps(job))
+            raise
+        except Exception as e:
+            job["tentativas"] += 1
+            job["repetido"] = True
+            if job["tentativas"] >= FILA_TENTATIVAS:
+                print(f"ERRO worker {numero}: {job['telefone']} desistiu apos {job['tentativas']} tentativas: {e}")
+                await registrar_falha_fila(job, str(e))
+            else:
+                espera = FILA_BACKOFF * 2 ** (job["tentativas"] - 1)
+                print(f"ERRO worker {numero}: {job['telefone']} nova tentativa em {espera:.0f}s: {e}")
+                tarefa = asyncio.create_task(_reenfileirar(job, espera))
+                _reenvios[tarefa] = job
+                tarefa.add_done_callback(lambda t: _reenvios.pop(t, None))
+        finally:
+            fila_entrada.task_done()
+
 # ============================================================
 # ROTAS PUBLICAS
 # ============================================================
 
+@app.middleware("http")
+async def contar_round_trips_requisicao(request: Request, call_next):
+    with medir_round_trips() as round_trips:
+        response = await call_next(request)
+    response.headers["X-Redis-Round-Trips"] = str(round_trips[0])
+    return response
+
+
 @app.get("/")
 def status():
     return {"status": f"{AGENT_NAME} online"}
 
 
+@app.get("/health")
+async def health():
+    try:
+        await asyncio.wait_for(r.ping(), timeout=REDIS_TIMEOUT)
+        return {"status": "ok", "redis": "ok"}
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Redis indisponivel: {e}")
+
+
 @app.get("/pagamento", response_class=HTMLResponse)
 async def pagina_pagamento(ref: str = ""):
     """Pagina de pagamento com link para o plano MP."""
@@ -499,7 +2362,7 @@ async def pagamento_obrigado(external_reference: str = "", collection_status: st
             "data_inicio": datetime.now().isoformat(),
             "expira": (datetime.now() + timedelta(days=35)).isoformat()
         }
-        salvar_assinatura(external_reference, dados)
+        await salvar_assinatura(external_reference, dados)
         await enviar_whatsapp(external_reference,
             "Seu acesso Premium esta ativo! 🎉\n\nBem-vindo ao PrimeiraMente Premium. Pode me contar agora o que esta acontecendo com seu filho — estou aqui para ajudar com orientacoes completas 🧠💙")
 
@@ -529,9 +2392,17 @@ async def pagamento_obrigado(external_reference: str = "", collection_status: st
 # WEBHOOK MERCADO PAGO
 # ============================================================
 
+# Z-API e Mercado Pago reenviam o mesmo evento quando nao recebem resposta a tempo;
+# o id de cada um fica guardado por WEBHOOK_DEDUP_HORAS e repeticoes sao descartadas
+WEBHOOK_VISTO_PREFIX = "webhook:visto:"
+
+async def evento_novo(origem: str, id_evento: str) -> bool:
+    return bool(await r.set(f"{WEBHOOK_VISTO_PREFIX}{origem}:{id_evento}", 1, nx=True, ex=int(WEBHOOK_DEDUP_HORAS * 3600)))
+
+
 @app.post("/webhook/mercadopago")
 async def webhook_mercadopago(request: Request):
-    """Recebe notificacoes de pagamento do Mercado Pago."""
+    """Recebe notificacoes de pagamento do Mercado Pago. A consulta ao MP fica para o reconciliador."""
     try:
         dados = await request.json()
         print(f"MP WEBHOOK: {json.dumps(dados)[:300]}")
@@ -542,146 +2413,266 @@ async def webhook_mercadopago(request: Request):
         if not id_mp:
             return {"status": "ignorado"}
 
+        # Notificacoes novas trazem o proprio id; as antigas (IPN) so o tipo e o recurso
+        id_evento = str(dados.get("id") or f"{tipo}:{id_mp}")
+        if not await evento_novo("mp", id_evento):
+            return {"status": "duplicado"}
+
         # Assinatura criada ou atualizada
         if "subscription" in tipo or "preapproval" in tipo:
-            await processar_assinatura_mp(str(id_mp))
+            await agendar_consulta_mp("assinatura", str(id_mp))
         # Pagamento avulso (cobranca recorrente)
         elif "payment" in tipo:
-            await processar_pagamento_mp(str(id_mp))
+            await agendar_consulta_mp("pagamento", str(id_mp))
 
         return {"status": "ok"}
     except Exception as e:
         print(f"ERRO webhook MP: {e}")
         return {"status": "erro", "detalhe": str(e)}
 
+# ------------------------------------------------------------
+# Reconciliador: o MP costuma mandar varias notificacoes seguidas para a mesma assinatura.
+# Cada id entra uma vez em um zset (score = quando consultar) e e consultado uma vez so
+# depois de MP_AGRUPAR_SEGUNDOS; falhas voltam para o zset com espera dobrada.
+# ------------------------------------------------------------
+MP_PENDENTES_KEY   = "mp:pendentes"    # zset "tipo:id" -> quando consultar (timestamp)
+MP_TENTATIVAS_KEY  = "mp:tentativas"   # hash "tipo:id" -> consultas que falharam
+MP_CACHE_PREFIX    = "mp:cache:"
+MP_CAMINHOS        = {"assinatura": "/preapproval/{}", "pagamento": "/v1/payments/{}"}
+
+async def agendar_consulta_mp(tipo: str, id_mp: str):
+    # Notificacao nova significa que o recurso mudou: a proxima consulta nao pode vir do cache
+    pipe = r.pipeline()
+    pipe.delete(f"{MP_CACHE_PREFIX}{MP_CAMINHOS[tipo].format(id_mp)}")
+    pipe.zadd(MP_PENDENTES_KEY, {f"{tipo}:{id_mp}": time.time() + MP_AGRUPAR_SEGUNDOS}, nx=True)
+    await pipe.execute()
+
+async def consultar_mp(caminho: str) -> dict | None:
+    """GET na API do MP, com a resposta guardada por MP_CACHE_SEGUNDOS. None se falhou."""
+    chave = f"{MP_CACHE_PREFIX}{caminho}"
+    if em_cache := await r.get(chave):
+        return json.loads(em_cache)
+    res = await requisitar(
+        "mercadopago", "GET",
+        f"https://api.mercadopago.com{caminho}",
+        headers={"Authorization": f"Bearer {MP_ACCESS_TOKEN}"}
+    )
+    if res.status_code != 200:
+        print(f"MP ERRO: {res.status_code} em {caminho}")
+        return None
+    dados = res.json()
+    await r.set(chave, json.dumps(dados), ex=MP_CACHE_SEGUNDOS)
+    return dados
+
+async def reconciliador_mp():
+    while True:
+        try:
+            prontos = await r.zrangebyscore(MP_PENDENTES_KEY, "-inf", time.time(), start=0, num=20)
+            for item in prontos:
+                # ZREM so retorna 1 para quem pegou o item primeiro (varias instancias do app)
+                if not await r.zrem(MP_PENDENTES_KEY, item):
+                    continue
+                tipo, id_mp = item.split(":", 1)
+                processar = processar_assinatura_mp if tipo == "assinatura" else processar_pagamento_mp
+                if await processar(id_mp):
+                    await r.hdel(MP_TENTATIVAS_KEY, item)
+                    continue
+                tentativas = await r.hincrby(MP_TENTATIVAS_KEY, item, 1)
+                if tentativas >= MP_TENTATIVAS:
+                    print(f"MP: desistindo de {item} apos {tentativas} tentativas")
+                    await r.hdel(MP_TENTATIVAS_KEY, item)
+                else:
+                    await r.zadd(MP_PENDENTES_KEY, {item: time.time() + FILA_BACKOFF * 2 ** tentativas})
+            if not prontos:
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"ERRO no reconciliador MP: {e}")
+            await asyncio.sleep(5)
+
 
-async def processar_assinatura_mp(preapproval_id: str):
-    """Busca detalhes da assinatura no MP e ativa/desativa o usuario."""
-    if not MP_ACCESS_TOKEN:
+async def aplicar_preapproval(dados: dict, avisar: bool = True):
+    """Atualiza a assinatura local a partir de uma preapproval do MP. So avisa o usuario
+    quando o status muda, entao notificacoes repetidas e a sincronizacao nao reenviam mensagens."""
+    preapproval_id  = dados.get("id", "")
+    telefone        = dados.get("external_reference", "")
+    status_mp       = dados.get("status", "")  # authorized, paused, cancelled
+    proximo_debito  = dados.get("next_payment_date", "")
+
+    if not telefone:
+        print(f"MP: external_reference vazio em {preapproval_id} — nao foi possivel identificar usuario")
         return
-    try:
-        async with httpx.AsyncClient(timeout=30) as http:
-            res = await http.get(
-                f"https://api.mercadopago.com/preapproval/{preapproval_id}",
-                headers={"Authorization": f"Bearer {MP_ACCESS_TOKEN}"}
-            )
-            if res.status_code != 200:
-                print(f"MP ASSINATURA ERRO: {res.status_code}")
-                return
-            dados = res.json()
 
-        telefone        = dados.get("external_reference", "")
-        status_mp       = dados.get("status", "")  # authorized, paused, cancelled
-        proximo_debito  = dados.get("next_payment_date", "")
+    status_local = "ativo" if status_mp == "authorized" else "inativo"
+    expira = None
+    if proximo_debito:
+        try:
+            expira = (datetime.fromisoformat(proximo_debito[:10]) + timedelta(days=5)).isoformat()
+        except Exception:
+            expira = (datetime.now() + timedelta(days=35)).isoformat()
 
-        if not telefone:
-            print("MP: external_reference vazio — nao foi possivel identificar usuario")
-            return
+    anterior = await obter_assinatura(telefone)
+    assinatura = {
+        "telefone": telefone,
+        "status": status_local,
+        "plano": "premium",
+        "preapproval_id": preapproval_id,
+        "status_mp": status_mp,
+        "data_inicio": anterior.get("data_inicio") or datetime.now().isoformat(),
+        "expira": expira or (datetime.now() + timedelta(days=35)).isoformat()
+    }
+    if all(anterior.get(campo) == assinatura[campo] for campo in ("status", "status_mp", "expira")):
+        return
+    await salvar_assinatura(telefone, assinatura)
+    print(f"ASSINATURA ATUALIZADA: {telefone} → {status_local}")
 
-        status_local = "ativo" if status_mp == "authorized" else "inativo"
-        expira = None
-        if proximo_debito:
-            try:
-                expira = (datetime.fromisoformat(proximo_debito[:10]) + timedelta(days=5)).isoformat()
-            except Exception:
-                expira = (datetime.now() + timedelta(days=35)).isoformat()
-
-        assinatura = {
-            "telefone": telefone,
-            "status": status_local,
-            "plano": "premium",
-            "preapproval_id": preapproval_id,
-            "status_mp": status_mp,
-            "data_inicio": datetime.now().isoformat(),
-            "expira": expira or (datetime.now() + timedelta(days=35)).isoformat()
-        }
-        salvar_assinatura(telefone, assinatura)
-        print(f"ASSINATURA ATUALIZADA: {telefone} → {status_local}")
+    if not avisar or anterior.get("status_mp") == status_mp:
+        return
+    if status_local == "ativo":
+        await enviar_whatsapp(telefone,
+            "Seu acesso Premium esta ativo! 🎉\n\nBem-vindo ao PrimeiraMente Premium. Pode me contar o que esta acontecendo com seu filho — estou aqui para ajudar com orientacoes completas 🧠💙")
+    elif status_mp in ("cancelled", "paused"):
+        await enviar_whatsapp(telefone,
+            "Seu plano Premium foi cancelado. Sentiremos sua falta 💙\n\nSe quiser reativar a qualquer momento, e so me chamar aqui!")
 
-        if status_local == "ativo":
-            await enviar_whatsapp(telefone,
-                "Seu acesso Premium esta ativo! 🎉\n\nBem-vindo ao PrimeiraMente Premium. Pode me contar o que esta acontecendo com seu filho — estou aqui para ajudar com orientacoes completas 🧠💙")
-        elif status_mp in ("cancelled", "paused"):
-            await enviar_whatsapp(telefone,
-                "Seu plano Premium foi cancelado. Sentiremos sua falta 💙\n\nSe quiser reativar a qualquer momento, e so me chamar aqui!")
+
+async def processar_assinatura_mp(preapproval_id: str) -> bool:
+    """Busca detalhes da assinatura no MP e ativa/desativa o usuario.
+    Retorna False quando a consulta ao MP falhou e vale a pena processar de novo."""
+    if not MP_ACCESS_TOKEN:
+        return True
+    try:
+        dados = await consultar_mp(MP_CAMINHOS["assinatura"].format(preapproval_id))
+        if dados is None:
+            return False
+        await aplicar_preapproval(dados)
+        return True
 
     except Exception as e:
         print(f"ERRO ao processar assinatura MP: {e}")
+        return False
 
 
-async def processar_pagamento_mp(payment_id: str):
-    """Processa um pagamento recorrente aprovado."""
+async def processar_pagamento_mp(payment_id: str) -> bool:
+    """Processa um pagamento recorrente aprovado.
+    Retorna False quando a consulta ao MP falhou e vale a pena processar de novo."""
     if not MP_ACCESS_TOKEN:
-        return
+        return True
     try:
-        async with httpx.AsyncClient(timeout=30) as http:
-            res = await http.get(
-                f"https://api.mercadopago.com/v1/payments/{payment_id}",
-                headers={"Authorization": f"Bearer {MP_ACCESS_TOKEN}"}
-            )
-            if res.status_code != 200:
-                return
-            dados = res.json()
+        dados = await consultar_mp(MP_CAMINHOS["pagamento"].format(payment_id))
+        if dados is None:
+            return False
 
         status_pg  = dados.get("status", "")
         telefone   = dados.get("external_reference", "")
 
         if not telefone:
-            return
+            return True
 
         if status_pg == "approved":
-            assinatura = obter_assinatura(telefone)
+            assinatura = await obter_assinatura(telefone)
             assinatura["status"] = "ativo"
             assinatura["expira"] = (datetime.now() + timedelta(days=35)).isoformat()
             assinatura["ultimo_pagamento"] = datetime.now().isoformat()
-            salvar_assinatura(telefone, assinatura)
+            await salvar_assinatura(telefone, assinatura)
             print(f"PAGAMENTO APROVADO: {telefone}")
         elif status_pg in ("rejected", "cancelled"):
-            assinatura = obter_assinatura(telefone)
+            assinatura = await obter_assinatura(telefone)
+            if assinatura.get("status") == "inativo":
+                return True
             assinatura["status"] = "inativo"
-            salvar_assinatura(telefone, assinatura)
+            await salvar_assinatura(telefone, assinatura)
             await enviar_whatsapp(telefone,
                 "Tivemos um problema com o pagamento da sua assinatura 😕\n\nPor favor, atualize seu metodo de pagamento para continuar com o acesso Premium.")
+        return True
 
     except Exception as e:
         print(f"ERRO ao processar pagamento MP: {e}")
+        return False
+
+
+async def sincronizar_mp() -> int:
+    """Percorre todas as assinaturas do plano pela busca do MP e aplica o estado atual de cada
+    uma, sem avisar ninguem. Corrige o que se perdeu em notificacoes que nao chegaram."""
+    if not MP_ACCESS_TOKEN:
+        print("SINCRONIZACAO MP: MP_ACCESS_TOKEN nao configurado")
+        return 0
+    total, offset = 0, 0
+    while True:
+        res = await requisitar(
+            "mercadopago", "GET",
+            "https://api.mercadopago.com/preapproval/search",
+            params={"preapproval_plan_id": MP_PLAN_ID, "offset": offset, "limit": 100},
+            headers={"Authorization": f"Bearer {MP_ACCESS_TOKEN}"}
+        )
+        if res.status_code != 200:
+            print(f"SINCRONIZACAO MP ERRO: {res.status_code} no offset {offset}")
+            break
+        pagina = res.json()
+        resultados = pagina.get("results", [])
+        for dados in resultados:
+            await aplicar_preapproval(dados, avisar=False)
+        total  += len(resultados)
+        offset += len(resultados)
+        if not resultados or offset >= pagina.get("paging", {}).get("total", 0):
+            break
+    print(f"SINCRONIZACAO MP: {total} assinaturas conferidas")
+    return total
+
+async def sincronizar_mp_diariamente():
+    if MP_SINCRONIZAR_HORA < 0:
+        return
+    while True:
+        agora   = datetime.now()
+        proxima = agora.replace(hour=MP_SINCRONIZAR_HORA, minute=0, second=0, microsecond=0)
+        if proxima <= agora:
+            proxima += timedelta(days=1)
+        await asyncio.sleep((proxima - agora).total_seconds())
+        # Com varias instancias, so a primeira a pegar a trava do dia sincroniza
+        if not await r.set(f"mp:sincronizacao:{proxima.date()}", 1, nx=True, ex=86400):
+            continue
+        try:
+            await sincronizar_mp()
+        except Exception as e:
+            print(f"ERRO na sincronizacao MP: {e}")
 
 # ============================================================
 # PAINEL ADMIN — USUARIOS
 # ============================================================
 
+USUARIOS_POR_PAGINA = 50
+
 @app.get("/admin", response_class=HTMLResponse)
-def painel_admin(admin: str = Depends(verificar_admin)):
-    chaves = r.keys("historico:*")
+async def painel_admin(admin: str = Depends(verificar_admin), pagina: int = 1, busca: str = "", ordem: str = "recentes"):
+    # So le o resumo de cada usuario da pagina; nenhum historico e decodificado aqui
+    busca  = re.sub(r"\D", "", busca)
+    ordem  = ordem if ordem in ("recentes", "telefone") else "recentes"
+    pagina = max(pagina, 1)
+    usuarios, encontrados, ordem_usada = await listar_usuarios(pagina, USUARIOS_POR_PAGINA, busca, ordem)
 
-    total_usuarios  = len(chaves)
-    total_premium   = len([1 for c in r.keys(f"{ASSINATURA_PREFIX}*")
-                           if json.loads(r.get(c) or "{}").get("status") == "ativo"])
-    total_consultas = len([1 for c in r.keys(f"{CONSULTA_PREFIX}*")
-                           if not json.loads(r.get(c) or "{}").get("atendido")])
+    contadores = await contadores_painel()
 
     stats = f"""
     <div class="stats">
-        <div class="stat"><div class="num">{total_usuarios}</div><div class="label">Usuarios</div></div>
-        <div class="stat"><div class="num">{total_premium}</div><div class="label">Premium ativos</div></div>
-        <div class="stat"><div class="num">{total_consultas}</div><div class="label">Consultas pendentes</div></div>
+        <div class="stat"><div class="num">{contadores["usuarios"]}</div><div class="label">Usuarios</div></div>
+        <div class="stat"><div class="num">{contadores["premium"]}</div><div class="label">Premium ativos</div></div>
+        <div class="stat"><div class="num">{contadores["consultas"]}</div><div class="label">Consultas pendentes</div></div>
     </div>"""
 
     rows = ""
-    for chave in sorted(chaves):
-        telefone  = chave.replace("historico:", "")
-        historico = obter_historico(telefone)
-        total     = len(historico)
-        ultima    = historico[-1]["content"][:80] + "..." if historico else "—"
-        premium   = eh_premium(telefone)
-        badge     = '<span class="badge badge-premium">Premium</span>' if premium else '<span class="badge badge-freemium">Freemium</span>'
+    for usuario in usuarios:
+        telefone = usuario["telefone"]
+        ultima   = usuario["ultima"] + "..." if usuario.get("ultima") else "—"
+        premium  = assinatura_ativa(usuario)
+        badge    = '<span class="badge badge-premium">Premium</span>' if premium else '<span class="badge badge-freemium">Freemium</span>'
         rows += f"""
         <div class="aluno-row">
             <div>
                 <div>
                     <a href="/admin/conversa/{telefone}">{telefone}</a>
                     {badge}
-                    <span class="badge" style="background:#e0e7ff;color:#4f46e5">{total} msgs</span>
+                    <span class="badge" style="background:#e0e7ff;color:#4f46e5">{usuario.get("msgs", 0)} msgs</span>
                 </div>
                 <div class="aluno-info">{ultima}</div>
             </div>
@@ -691,22 +2682,41 @@ def painel_admin(admin: str = Depends(verificar_admin)):
         </div>"""
 
     if not rows:
-        rows = "<p style='color:#888;padding:20px 0'>Nenhum usuario ainda.</p>"
+        rows = "<p style='color:#888;padding:20px 0'>Nenhum usuario encontrado.</p>" if busca else "<p style='color:#888;padding:20px 0'>Nenhum usuario ainda.</p>"
+
+    paginas = max((encontrados + USUARIOS_POR_PAGINA - 1) // USUARIOS_POR_PAGINA, 1)
+    filtros = f"busca={busca}&ordem={ordem}"
+    navegacao = f"""
+        <div style="display:flex;justify-content:space-between;align-items:center;margin-top:12px;">
+            {f'<a href="/admin?pagina={pagina - 1}&{filtros}" class="btn btn-primary">← Anterior</a>' if pagina > 1 else "<span></span>"}
+            <span class="aluno-info">Pagina {pagina} de {paginas}</span>
+            {f'<a href="/admin?pagina={pagina + 1}&{filtros}" class="btn btn-primary">Proxima →</a>' if pagina < paginas else "<span></span>"}
+        </div>"""
 
     conteudo = stats + f"""
     <div class="card">
-        <h2>Usuarios ({total_usuarios} total)</h2>
+        <h2>Usuarios ({encontrados} {"encontrados" if busca else "total"})</h2>
+        <form method="get" action="/admin" style="display:flex;gap:8px;margin-bottom:12px;">
+            <input type="text" name="busca" value="{busca}" placeholder="Buscar pelo inicio do telefone">
+            <select name="ordem">
+                <option value="recentes" {"selected" if ordem == "recentes" else ""}>Atividade recente</option>
+                <option value="telefone" {"selected" if ordem == "telefone" else ""}>Telefone</option>
+            </select>
+            <button type="submit" class="btn btn-primary">Buscar</button>
+        </form>
+        {f'<div class="total">Mais de {BUSCA_ORDENAR_MAX} encontrados: mostrando por ordem de telefone. Digite mais numeros para ordenar por atividade.</div>' if ordem_usada != ordem else ""}
         {rows}
+        {navegacao}
     </div>"""
 
     return HTMLResponse(base_html("Usuarios", conteudo, "usuarios"))
 
 
 @app.get("/admin/conversa/{telefone}", response_class=HTMLResponse)
-def ver_conversa(telefone: str, admin: str = Depends(verificar_admin)):
-    historico = obter_historico(telefone)
-    assinatura = obter_assinatura(telefone)
-    premium = eh_premium(telefone)
+async def ver_conversa(telefone: str, admin: str = Depends(verificar_admin)):
+    historico = await obter_historico(telefone)
+    assinatura = await obter_assinatura(telefone)
+    premium = await eh_premium(telefone)
 
     status_badge = '<span class="badge badge-ativo">Premium ativo</span>' if premium else '<span class="badge badge-freemium">Freemium</span>'
     expira = assinatura.get("expira", "")
@@ -748,8 +2758,8 @@ def ver_conversa(telefone: str, admin: str = Depends(verificar_admin)):
 
 
 @app.get("/admin/apagar/{telefone}")
-def apagar_historico(telefone: str, admin: str = Depends(verificar_admin)):
-    r.delete(f"historico:{telefone}")
+async def apagar_historico(telefone: str, admin: str = Depends(verificar_admin)):
+    await apagar_historico_dados(telefone)
     return RedirectResponse(url="/admin")
 
 # ============================================================
@@ -757,8 +2767,8 @@ def apagar_historico(telefone: str, admin: str = Depends(verificar_admin)):
 # ============================================================
 
 @app.get("/admin/assinaturas", response_class=HTMLResponse)
-def painel_assinaturas(admin: str = Depends(verificar_admin), msg: str = ""):
-    assinaturas = listar_assinaturas()
+async def painel_assinaturas(admin: str = Depends(verificar_admin), msg: str = ""):
+    assinaturas = await listar_assinaturas()
     aviso = f'<div class="success">{msg}</div>' if msg else ""
 
     rows = ""
@@ -771,6 +2781,8 @@ def painel_assinaturas(admin: str = Depends(verificar_admin), msg: str = ""):
 
         if status == "ativo":
             badge = '<span class="badge badge-ativo">Ativo</span>'
+        elif status == "inativo" and assin.get("vencida_em"):
+            badge = '<span class="badge badge-inativo">Vencida</span>'
         elif status == "inativo":
             badge = '<span class="badge badge-inativo">Inativo</span>'
         else:
@@ -846,33 +2858,33 @@ async def nova_assinatura_post(
         "data_inicio": datetime.now().isoformat(),
         "expira": (datetime.now() + timedelta(days=dias)).isoformat()
     }
-    salvar_assinatura(telefone, dados)
+    await salvar_assinatura(telefone, dados)
     print(f"ASSINATURA MANUAL: {telefone} por {dias} dias")
     return RedirectResponse(url="/admin/assinaturas?msg=Assinatura+ativada+com+sucesso!", status_code=303)
 
 
 @app.get("/admin/assinaturas/ativar/{telefone}")
-def ativar_assinatura(telefone: str, admin: str = Depends(verificar_admin)):
-    assinatura = obter_assinatura(telefone)
+async def ativar_assinatura(telefone: str, admin: str = Depends(verificar_admin)):
+    assinatura = await obter_assinatura(telefone)
     assinatura["status"] = "ativo"
     assinatura["plano"]  = "premium"
     assinatura["expira"] = (datetime.now() + timedelta(days=35)).isoformat()
     assinatura["origem"] = assinatura.get("origem", "manual")
-    salvar_assinatura(telefone, assinatura)
+    await salvar_assinatura(telefone, assinatura)
     return RedirectResponse(url="/admin/assinaturas?msg=Usuario+ativado!")
 
 
 @app.get("/admin/assinaturas/desativar/{telefone}")
-def desativar_assinatura(telefone: str, admin: str = Depends(verificar_admin)):
-    assinatura = obter_assinatura(telefone)
+async def desativar_assinatura(telefone: str, admin: str = Depends(verificar_admin)):
+    assinatura = await obter_assinatura(telefone)
     assinatura["status"] = "inativo"
-    salvar_assinatura(telefone, assinatura)
+    await salvar_assinatura(telefone, assinatura)
     return RedirectResponse(url="/admin/assinaturas?msg=Usuario+desativado!")
 
 
 @app.get("/admin/assinaturas/apagar/{telefone}")
-def apagar_assinatura(telefone: str, admin: str = Depends(verificar_admin)):
-    r.delete(f"{ASSINATURA_PREFIX}{telefone}")
+async def apagar_assinatura(telefone: str, admin: str = Depends(verificar_admin)):
+    await apagar_assinatura_dados(telefone)
     return RedirectResponse(url="/admin/assinaturas")
 
 # ============================================================
@@ -880,8 +2892,8 @@ def apagar_assinatura(telefone: str, admin: str = Depends(verificar_admin)):
 # ============================================================
 
 @app.get("/admin/consultas", response_class=HTMLResponse)
-def painel_consultas(admin: str = Depends(verificar_admin)):
-    consultas = listar_consultas()
+async def painel_consultas(admin: str = Depends(verificar_admin)):
+    consultas = await listar_consultas()
     pendentes = [c for c in consultas if not c.get("atendido")]
     atendidas = [c for c in consultas if c.get("atendido")]
 
@@ -918,8 +2930,8 @@ def painel_consultas(admin: str = Depends(verificar_admin)):
 
 
 @app.get("/admin/consultas/atender/{telefone}")
-def atender_consulta(telefone: str, admin: str = Depends(verificar_admin)):
-    marcar_consulta_atendida(telefone)
+async def atender_consulta(telefone: str, admin: str = Depends(verificar_admin)):
+    await marcar_consulta_atendida(telefone)
     return RedirectResponse(url="/admin/consultas")
 
 # ============================================================
@@ -927,8 +2939,8 @@ def atender_consulta(telefone: str, admin: str = Depends(verificar_admin)):
 # ============================================================
 
 @app.get("/admin/prompt", response_class=HTMLResponse)
-def editar_prompt_get(admin: str = Depends(verificar_admin), salvo: str = ""):
-    prompt_atual = obter_prompt()
+async def editar_prompt_get(admin: str = Depends(verificar_admin), salvo: str = ""):
+    prompt_atual = await obter_prompt()
     aviso = '<div class="success">Prompt salvo com sucesso!</div>' if salvo == "1" else ""
     conteudo = f"""
     {aviso}
@@ -952,27 +2964,156 @@ async def editar_prompt_post(
     prompt: str = Form(...),
     admin: str = Depends(verificar_admin)
 ):
-    salvar_prompt(prompt.strip())
+    await salvar_prompt(prompt.strip())
     return RedirectResponse(url="/admin/prompt?salvo=1", status_code=303)
 
+# ============================================================
+# PAINEL ADMIN — RESPOSTAS PRONTAS (INTENCOES)
+# ============================================================
+
+@app.get("/admin/respostas", response_class=HTMLResponse)
+async def painel_respostas(admin: str = Depends(verificar_admin), salvo: str = ""):
+    regras = await obter_regras_intencao()
+    contagem = {campo: int(valor) for campo, valor in (await r.hgetall(INTENCOES_METRICAS)).items()}
+    aviso = '<div class="success">Regras salvas com sucesso!</div>' if salvo == "1" else ""
+    padrao = {regra["nome"] for regra in REGRAS_PADRAO}
+
+    cards = ""
+    for i, regra in enumerate(regras):
+        apagar = "" if regra["nome"] in padrao else f'<a href="/admin/respostas/apagar/{i}" onclick="return confirm(\'Apagar regra {regra["nome"]}?\')" class="btn btn-danger">Apagar</a>'
+        cards += f"""
+    <div class="card">
+        <div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:16px;">
+            <h2 style="margin:0">{regra["nome"]} <span class="badge badge-ativo">{contagem.get(regra["nome"], 0)} respondidas</span></h2>
+            {apagar}
+        </div>
+        <form method="post" action="/admin/respostas/{i}">
+            <label style="font-size:13px;color:#555;display:block;margin-bottom:6px;">Palavras ou expressoes (separadas por virgula)</label>
+            <input type="text" name="palavras" value="{", ".join(regra.get("palavras", []))}">
+            <label style="font-size:13px;color:#555;display:block;margin:12px 0 6px;">Responder sem IA so se a mensagem tiver ate N palavras</label>
+            <input type="number" name="max_palavras" value="{regra.get("max_palavras", 8)}" min="1">
+            <label style="font-size:13px;color:#555;display:block;margin:12px 0 6px;">Resposta</label>
+            <textarea name="resposta" style="min-height:90px">{regra.get("resposta", "")}</textarea>
+            <label style="font-size:13px;color:#555;display:block;margin:12px 0 6px;">Resposta para Premium (vazio = mesma resposta)</label>
+            <textarea name="resposta_premium" style="min-height:90px">{regra.get("resposta_premium", "")}</textarea>
+            <label style="font-size:13px;color:#555;display:block;margin:12px 0;">
+                <input type="checkbox" name="ativa" value="1" {"checked" if regra.get("ativa") else ""}> Regra ativa
+            </label>
+            <label style="font-size:13px;color:#555;display:block;margin:12px 0;">
+                <input type="checkbox" name="mensagem_inteira" value="1" {"checked" if regra.get("mensagem_inteira") else ""}> So quando a mensagem tiver apenas essas palavras
+            </label>
+            <label style="font-size:13px;color:#555;display:block;margin:12px 0;">
+                <input type="checkbox" name="primeiro_turno" value="1" {"checked" if regra.get("primeiro_turno") else ""}> So na primeira mensagem da conversa
+            </label>
+            <button type="submit" class="btn btn-primary">Salvar</button>
+        </form>
+    </div>"""
+
+    respondidas = sum(valor for campo, valor in contagem.items() if campo != "ia")
+    total = respondidas + contagem.get("ia", 0)
+    taxa  = round(100 * respondidas / total, 1) if total else 0
+
+    conteudo = f"""
+    {aviso}
+    <div class="stats">
+        <div class="stat"><div class="num">{respondidas}</div><div class="label">Sem IA</div></div>
+        <div class="stat"><div class="num">{contagem.get("ia", 0)}</div><div class="label">Com Claude</div></div>
+        <div class="stat"><div class="num">{taxa}%</div><div class="label">Respondidas sem IA</div></div>
+    </div>
+    <div class="card">
+        <p style="font-size:13px;color:#888;">
+            Mensagens curtas que contem uma das palavras sao respondidas na hora com o texto abaixo, sem chamar o Claude.
+            Vale a primeira regra da lista que casar. Use <code>{{LINK_PAGAMENTO}}</code> e <code>{{NOME_AGENTE}}</code> nas respostas.
+            A regra <strong>consulta</strong> tambem registra o interesse do usuario em consulta.
+        </p>
+    </div>
+    {cards}
+    <div class="card">
+        <h2>Nova regra</h2>
+        <form method="post" action="/admin/respostas/nova" style="display:flex;gap:8px;">
+            <input type="text" name="nome" required placeholder="horarios">
+            <button type="submit" class="btn btn-primary">Criar</button>
+        </form>
+    </div>"""
+    return HTMLResponse(base_html("Respostas prontas", conteudo, "respostas"))
+
+
+@app.post("/admin/respostas/nova")
+async def nova_regra_intencao(nome: str = Form(...), admin: str = Depends(verificar_admin)):
+    regras = await obter_regras_intencao()
+    nome_seguro = re.sub(r"[^a-zA-Z0-9_\-]", "", nome).lower() or "regra"
+    regras.append({"nome": nome_seguro, "ativa": False, "max_palavras": 8, "mensagem_inteira": False, "primeiro_turno": False, "palavras": [], "resposta": "", "resposta_premium": ""})
+    await salvar_regras_intencao(regras)
+    return RedirectResponse(url="/admin/respostas?salvo=1", status_code=303)
+
+
+@app.post("/admin/respostas/{indice}")
+async def salvar_regra_intencao(
+    indice: int,
+    palavras: str = Form(""),
+    max_palavras: int = Form(8),
+    resposta: str = Form(""),
+    resposta_premium: str = Form(""),
+    ativa: str = Form(""),
+    mensagem_inteira: str = Form(""),
+    primeiro_turno: str = Form(""),
+    admin: str = Depends(verificar_admin)
+):
+    regras = await obter_regras_intencao()
+    if 0 <= indice < len(regras):
+        regras[indice].update(
+            palavras=[p.strip() for p in palavras.split(",") if p.strip()],
+            max_palavras=max(max_palavras, 1),
+            resposta=resposta.strip(),
+            resposta_premium=resposta_premium.strip(),
+            ativa=ativa == "1",
+            mensagem_inteira=mensagem_inteira == "1",
+            primeiro_turno=primeiro_turno == "1",
+        )
+        await salvar_regras_intencao(regras)
+    return RedirectResponse(url="/admin/respostas?salvo=1", status_code=303)
+
+
+@app.get("/admin/respostas/apagar/{indice}")
+async def apagar_regra_intencao(indice: int, admin: str = Depends(verificar_admin)):
+    regras = await obter_regras_intencao()
+    if 0 <= indice < len(regras) and regras[indice]["nome"] not in {regra["nome"] for regra in REGRAS_PADRAO}:
+        regras.pop(indice)
+        await salvar_regras_intencao(regras)
+    return RedirectResponse(url="/admin/respostas?salvo=1", status_code=303)
+
 # ============================================================
 # PAINEL ADMIN — ARQUIVOS DE REFERENCIA
 # ============================================================
 
 @app.get("/admin/arquivos", response_class=HTMLResponse)
-async def painel_arquivos(admin: str = Depends(verificar_admin), salvo: str = ""):
-    arquivos = listar_arquivos()
-    aviso = '<div class="success">Arquivo salvo com sucesso!</div>' if salvo == "1" else ""
+async def painel_arquivos(admin: str = Depends(verificar_admin), salvo: str = "", erro: str = ""):
+    arquivos = await listar_arquivos()
+    aviso = '<div class="success">Arquivo recebido! A leitura continua abaixo.</div>' if salvo == "1" else ""
+    if erro:
+        aviso = f'<div class="erro">{erro}</div>'
 
     rows = ""
     for arq in arquivos:
-        kb = round(arq["tamanho"] / 1024, 1)
         nome_arq = arq["nome"]
+        status   = arq.get("status", "pronto")
+        if status == "processando":
+            lidas, total = int(arq.get("paginas_lidas", 0)), int(arq.get("paginas_total", 0))
+            situacao = '<span class="badge badge-pendente">Lendo</span>'
+            info = f"Pagina {lidas} de {total}" if total else "Lendo arquivo..."
+        elif status == "erro":
+            situacao = '<span class="badge badge-inativo">Erro</span>'
+            info = arq.get("erro", "")
+        else:
+            caracteres = int(arq.get("caracteres", 0))
+            modo = "inteiro no prompt" if caracteres <= ARQUIVO_INTEGRAL_CHARS else "busca por trechos"
+            situacao = f'<span style="font-size:12px;color:#888;">{round(caracteres / 1024, 1)} KB de texto | {arq.get("trechos", 0)} trechos | {modo}</span>'
+            info = f"Use [{nome_arq}] no prompt para referenciar este arquivo"
         rows += f"""
         <div class="aluno-row">
             <div>
-                <div><strong>[{nome_arq}]</strong> &nbsp;<span style="font-size:12px;color:#888;">{kb} KB</span></div>
-                <div class="aluno-info">Use [{nome_arq}] no prompt para referenciar este arquivo</div>
+                <div><strong>[{nome_arq}]</strong> &nbsp;{situacao}</div>
+                <div class="aluno-info">{info}</div>
             </div>
             <a href="/admin/arquivos/apagar/{nome_arq}" onclick="return confirm('Apagar {nome_arq}?')">
                 <span class="btn btn-danger">Apagar</span>
@@ -981,6 +3122,9 @@ async def painel_arquivos(admin: str = Depends(verificar_admin), salvo: str = ""
 
     if not rows:
         rows = "<p style='color:#888;padding:12px 0'>Nenhum arquivo ainda.</p>"
+    # Atualiza a pagina sozinha enquanto algum arquivo esta sendo lido
+    if any(arq.get("status") == "processando" for arq in arquivos):
+        aviso += "<script>setTimeout(() => location.reload(), 3000)</script>"
 
     conteudo = f"""
     {aviso}
@@ -999,7 +3143,7 @@ async def painel_arquivos(admin: str = Depends(verificar_admin), salvo: str = ""
                 <input type="text" name="nome" required placeholder="metodologia" style="width:100%;padding:10px;border:1px solid #ddd;border-radius:8px;font-size:14px;">
             </div>
             <div style="margin-bottom:16px;">
-                <label style="font-size:13px;color:#555;display:block;margin-bottom:6px;">Arquivo (PDF ou TXT — max 500KB)</label>
+                <label style="font-size:13px;color:#555;display:block;margin-bottom:6px;">Arquivo (PDF ou TXT — max {ARQUIVO_MAX_KB // 1024}MB)</label>
                 <input type="file" name="arquivo" accept=".pdf,.txt,.md" required style="font-size:14px;">
             </div>
             <button type="submit" class="btn btn-primary">Salvar Arquivo</button>
@@ -1009,39 +3153,355 @@ async def painel_arquivos(admin: str = Depends(verificar_admin), salvo: str = ""
     return HTMLResponse(base_html("Arquivos", conteudo, "arquivos"))
 
 
+_leituras: set = set()  # referencias das leituras de upload em andamento
+
 @app.post("/admin/arquivos")
 async def upload_arquivo(
     nome: str = Form(...),
     arquivo: UploadFile = File(...),
     admin: str = Depends(verificar_admin)
 ):
-    conteudo_bytes = await arquivo.read()
-    filename = arquivo.filename.lower()
-
-    if filename.endswith(".pdf"):
-        try:
-            import pdfplumber
-            with pdfplumber.open(io.BytesIO(conteudo_bytes)) as pdf:
-                paginas = [p.extract_text() for p in pdf.pages[:30] if p.extract_text()]
-            texto_final = "\n\n".join(paginas)
-        except Exception as e:
-            texto_final = f"[Erro ao ler PDF: {e}]"
-    else:
-        try:
-            texto_final = conteudo_bytes.decode("utf-8")
-        except Exception:
-            texto_final = conteudo_bytes.decode("latin-1", errors="ignore")
+    try:
+        caminho = await salvar_upload(arquivo, ARQUIVO_MAX_KB * 1024)
+    except ArquivoGrandeDemais:
+        return RedirectResponse(url=f"/admin/arquivos?erro=Arquivo+maior+que+{ARQUIVO_MAX_KB // 1024}MB", status_code=303)
 
+    # A leitura (todas as paginas) segue em segundo plano; o painel mostra o progresso
     nome_seguro = re.sub(r"[^a-zA-Z0-9_\-]", "", nome).lower() or "arquivo"
-    salvar_arquivo(nome_seguro, texto_final)
+    tarefa = asyncio.create_task(ler_arquivo_enviado(nome_seguro, caminho, arquivo.filename.lower().endswith(".pdf")))
+    _leituras.add(tarefa)
+    tarefa.add_done_callback(_leituras.discard)
     return RedirectResponse(url="/admin/arquivos?salvo=1", status_code=303)
 
 
 @app.get("/admin/arquivos/apagar/{nome}")
-def apagar_arquivo_rota(nome: str, admin: str = Depends(verificar_admin)):
-    apagar_arquivo(nome)
+async def apagar_arquivo_rota(nome: str, admin: str = Depends(verificar_admin)):
+    await apagar_arquivo(nome)
     return RedirectResponse(url="/admin/arquivos")
 
+# ============================================================
+# PAINEL ADMIN — FILA DE PROCESSAMENTO
+# ============================================================
+
+@app.get("/admin/fila", response_class=HTMLResponse)
+async def painel_fila(admin: str = Depends(verificar_admin), msg: str = ""):
+    falhas = await listar_falhas_fila()
+    mp_pendentes = await r.zcard(MP_PENDENTES_KEY)
+    aviso = f'<div class="success">{msg}</div>' if msg else ""
+
+    stats = f"""
+    <div class="stats">
+        <div class="stat"><div class="num">{len(_pendentes)}</div><div class="label">Agrupando</div></div>
+        <div class="stat"><div class="num">{fila_entrada.qsize()}</div><div class="label">Aguardando</div></div>
+        <div class="stat"><div class="num">{len(_reenvios)}</div><div class="label">Em nova tentativa</div></div>
+        <div class="stat"><div class="num">{FILA_WORKERS}</div><div class="label">Workers</div></div>
+        <div class="stat"><div class="num">{len(falhas)}</div><div class="label">Falhas</div></div>
+        <div class="stat"><div class="num">{mp_pendentes}</div><div class="label">Consultas MP</div></div>
+    </div>"""
+
+    rows = ""
+    for i, falha in enumerate(falhas):
+        tel   = falha.get("telefone", "")
+        texto = " / ".join(m.get("text", {}).get("message", "") or "[midia]" for m in falha.get("mensagens", []))
+        rows += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{tel}</strong> <span class="badge badge-inativo">{falha.get("tentativas", 0)} tentativas</span></div>
+                <div class="aluno-info">{falha.get("data", "")} | {falha.get("erro", "")}</div>
+                <div class="aluno-info">Mensagem: {texto[:80]}</div>
+            </div>
+            <a href="/admin/fila/reprocessar/{i}" class="btn btn-success">Reprocessar</a>
+        </div>"""
+
+    if not rows:
+        rows = "<p style='color:#888;padding:12px 0'>Nenhuma falha.</p>"
+
+    limpar = '<a href="/admin/fila/limpar" onclick="return confirm(\'Limpar todas as falhas?\')" class="btn btn-danger">Limpar</a>' if falhas else ""
+    conteudo = stats + f"""
+    {aviso}
+    <div class="card">
+        <div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:16px;">
+            <h2>Mensagens com falha ({len(falhas)})</h2>
+            {limpar}
+        </div>
+        {rows}
+    </div>"""
+
+    return HTMLResponse(base_html("Fila", conteudo, "fila"))
+
+
+@app.get("/admin/fila/reprocessar/{indice}")
+async def reprocessar_falha(indice: int, admin: str = Depends(verificar_admin)):
+    bruto = await r.lindex(FILA_FALHAS_KEY, indice)
+    if not bruto:
+        return RedirectResponse(url="/admin/fila")
+    falha = json.loads(bruto)
+    await r.lrem(FILA_FALHAS_KEY, 1, bruto)
+    if await enfileirar_mensagens(falha.get("telefone", ""), falha.get("mensagens", []), falha.get("id", "")):
+        return RedirectResponse(url="/admin/fila?msg=Mensagem+enviada+para+a+fila!")
+    return RedirectResponse(url="/admin/fila?msg=Fila+cheia,+tente+novamente.")
+
+
+@app.get("/admin/fila/limpar")
+async def limpar_falhas_fila(admin: str = Depends(verificar_admin)):
+    await r.delete(FILA_FALHAS_KEY)
+    return RedirectResponse(url="/admin/fila")
+
+# ============================================================
+# PAINEL ADMIN — METRICAS
+# ============================================================
+
+@app.get("/admin/envios", response_class=HTMLResponse)
+async def painel_envios(admin: str = Depends(verificar_admin)):
+    contadores = {campo: int(valor) for campo, valor in (await r.hgetall(ENVIO_METRICAS)).items()}
+    envios = await listar_envios_recentes()
+
+    stats = f"""
+    <div class="stats">
+        <div class="stat"><div class="num">{sum(f.qsize() for f in filas_envio)}</div><div class="label">Na fila</div></div>
+        <div class="stat"><div class="num">{contadores.get("entregues", 0)}</div><div class="label">Entregues</div></div>
+        <div class="stat"><div class="num">{contadores.get("novas_tentativas", 0)}</div><div class="label">Novas tentativas</div></div>
+        <div class="stat"><div class="num">{contadores.get("falhas", 0)}</div><div class="label">Falhas</div></div>
+        <div class="stat"><div class="num">{ENVIO_RPM:g}</div><div class="label">Limite/min</div></div>
+    </div>"""
+
+    badges = {
+        "entregue": '<span class="badge badge-ativo">Entregue</span>',
+        "falhou":   '<span class="badge badge-inativo">Falhou</span>',
+        "tentando": '<span class="badge badge-pendente">Tentando</span>',
+        "na_fila":  '<span class="badge badge-freemium">Na fila</span>',
+    }
+    rows = ""
+    for envio in envios:
+        erro = f' | {envio["erro"]}' if envio.get("erro") and envio.get("status") != "entregue" else ""
+        rows += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{envio.get("telefone", "")}</strong> {badges.get(envio.get("status"), "")} <span class="badge" style="background:#e0e7ff;color:#4f46e5">{envio.get("tentativas", 0)} tentativas</span></div>
+                <div class="aluno-info">{envio.get("criado", "")}{erro}</div>
+                <div class="aluno-info">Mensagem: {envio.get("previa", "")}</div>
+            </div>
+        </div>"""
+
+    if not rows:
+        rows = "<p style='color:#888;padding:12px 0'>Nenhum envio recente.</p>"
+
+    conteudo = stats + f"""
+    <div class="card">
+        <h2>Ultimos envios ({len(envios)})</h2>
+        {rows}
+    </div>"""
+
+    return HTMLResponse(base_html("Envios", conteudo, "envios"))
+
+
+@app.get("/admin/cache", response_class=HTMLResponse)
+async def painel_cache_respostas(admin: str = Depends(verificar_admin), limpo: str = ""):
+    resumo   = await resumo_cache_respostas()
+    entradas = await listar_cache_respostas()
+    aviso = '<div class="success">Cache limpo.</div>' if limpo == "1" else ""
+
+    stats = f"""
+    <div class="stats">
+        <div class="stat"><div class="num">{resumo["entradas"]}</div><div class="label">Respostas guardadas</div></div>
+        <div class="stat"><div class="num">{resumo["acertos"]}</div><div class="label">Acertos</div></div>
+        <div class="stat"><div class="num">{resumo["falhas"]}</div><div class="label">Falhas</div></div>
+        <div class="stat"><div class="num">{resumo["taxa"]}%</div><div class="label">Reaproveitado</div></div>
+    </div>"""
+
+    rows = ""
+    for entrada in entradas:
+        rows += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{entrada.get("pergunta", "")[:120]}</strong> <span class="badge badge-{"premium" if entrada.get("status") == "PREMIUM" else "freemium"}">{entrada.get("status", "")}</span> <span class="badge" style="background:#e0e7ff;color:#4f46e5">{entrada.get("acertos", 0)} acertos</span></div>
+                <div class="aluno-info">Guardada em {entrada.get("criado", "")}</div>
+                <div class="aluno-info">Resposta: {entrada.get("resposta", "")[:200]}</div>
+            </div>
+            <a href="/admin/cache/apagar/{entrada["chave"]}" class="btn btn-danger">Apagar</a>
+        </div>"""
+
+    if not rows:
+        rows = "<p style='color:#888;padding:12px 0'>Nenhuma resposta guardada.</p>"
+
+    estado = "ligado" if RESPOSTAS_CACHE else "desligado — defina RESPOSTAS_CACHE=1 para ligar"
+    conteudo = aviso + stats + f"""
+    <div class="card">
+        <div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:16px;">
+            <h2 style="margin:0">Respostas guardadas ({len(entradas)})</h2>
+            <a href="/admin/cache/limpar" onclick="return confirm('Apagar todas as respostas guardadas?')" class="btn btn-danger">Limpar tudo</a>
+        </div>
+        <div class="total">Cache {estado} | validade {RESPOSTAS_CACHE_HORAS:g} h | maximo {RESPOSTAS_CACHE_MAX} respostas</div>
+        {rows}
+    </div>"""
+
+    return HTMLResponse(base_html("Cache de respostas", conteudo, "cache"))
+
+
+@app.get("/admin/cache/apagar/{chave}")
+async def apagar_cache_resposta(chave: str, admin: str = Depends(verificar_admin)):
+    await limpar_cache_respostas(chave)
+    return RedirectResponse(url="/admin/cache?limpo=1", status_code=303)
+
+
+@app.get("/admin/cache/limpar")
+async def limpar_cache_respostas_admin(admin: str = Depends(verificar_admin)):
+    await limpar_cache_respostas()
+    return RedirectResponse(url="/admin/cache?limpo=1", status_code=303)
+
+
+@app.get("/admin/modelos", response_class=HTMLResponse)
+async def painel_modelos(admin: str = Depends(verificar_admin), salvo: str = ""):
+    pipe = r.pipeline()
+    pipe.hgetall(ORCAMENTO_TOKENS_KEY)
+    pipe.hgetall(ROTEADOR_METRICAS)
+    orcamentos, motivos = await pipe.execute()
+    uso = await obter_uso_llm(f"{datetime.now():%Y-%m-%d}")
+    aviso = '<div class="success">Orcamento salvo!</div>' if salvo == "1" else ""
+
+    rotas = [("Padrao", AGENT_MODEL), ("Premium", AGENT_MODEL_PREMIUM), ("Mensagens complexas e midia", AGENT_MODEL_COMPLEXO)]
+    rows_rotas = ""
+    for nome, modelo in rotas:
+        rows_rotas += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{nome}</strong></div>
+                <div class="aluno-info">{modelo}</div>
+            </div>
+        </div>"""
+
+    rows = ""
+    for modelo in dict.fromkeys([AGENT_MODEL, AGENT_MODEL_PREMIUM, AGENT_MODEL_COMPLEXO, *orcamentos]):
+        gasto   = tokens_do_dia(uso, modelo)
+        limite  = int(orcamentos.get(modelo, 0))
+        p95     = percentil(latencias_llm.get(modelo, []), 0.95)
+        estourou = (limite and gasto >= limite) or lento_demais(modelo)
+        badge   = '<span class="badge badge-inativo">Desviando</span>' if estourou and modelo != AGENT_MODEL else '<span class="badge badge-ativo">Normal</span>'
+        rows += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{modelo}</strong> {badge}</div>
+                <div class="aluno-info">{gasto} tokens hoje{f" de {limite}" if limite else ""} | p95 {p95:.1f} s</div>
+            </div>
+            <form method="post" action="/admin/modelos/orcamento" style="display:flex;gap:8px;">
+                <input type="hidden" name="modelo" value="{modelo}">
+                <input type="number" name="tokens" value="{limite}" min="0" style="width:140px">
+                <button type="submit" class="btn btn-primary">Salvar</button>
+            </form>
+        </div>"""
+
+    total = sum(int(valor) for valor in motivos.values())
+    stats = '<div class="stats">' + "".join(
+        f'<div class="stat"><div class="num">{motivos.get(motivo, 0)}</div><div class="label">{rotulo}</div></div>'
+        for motivo, rotulo in [("padrao", "Padrao"), ("premium", "Premium"), ("complexa", "Complexas"),
+                               ("midia", "Midia"), ("orcamento", "Desvio por orcamento"), ("latencia", "Desvio por latencia")]
+    ) + "</div>"
+
+    conteudo = aviso + stats + f"""
+    <div class="card">
+        <h2>Rotas</h2>
+        <div class="total">{total} turnos roteados | mensagens a partir de {ROTEADOR_COMPLEXO_CHARS} caracteres contam como complexas</div>
+        {rows_rotas}
+    </div>
+    <div class="card">
+        <h2>Orcamento diario de tokens</h2>
+        <div class="total">Passando do orcamento do dia, ou do p95 de {LLM_SLO_P95:g} s nos ultimos {ROTEADOR_JANELA // 60} minutos, o modelo volta para {AGENT_MODEL}. 0 = sem limite.</div>
+        {rows}
+    </div>"""
+
+    return HTMLResponse(base_html("Modelos", conteudo, "modelos"))
+
+
+@app.post("/admin/modelos/orcamento")
+async def salvar_orcamento_modelo(modelo: str = Form(...), tokens: int = Form(0), admin: str = Depends(verificar_admin)):
+    await salvar_orcamento_tokens(modelo.strip(), tokens)
+    return RedirectResponse(url="/admin/modelos?salvo=1", status_code=303)
+
+
+@app.get("/admin/metricas", response_class=HTMLResponse)
+async def painel_metricas(admin: str = Depends(verificar_admin)):
+    uso = await obter_uso_llm(f"{datetime.now():%Y-%m-%d}")
+    entrada_total = uso.get("entrada", 0) + uso.get("cache_leitura", 0) + uso.get("cache_escrita", 0)
+    pct_cache = round(100 * uso.get("cache_leitura", 0) / entrada_total, 1) if entrada_total else 0
+
+    stats = f"""
+    <div class="stats">
+        <div class="stat"><div class="num">{uso.get("chamadas", 0)}</div><div class="label">Chamadas ao Claude hoje</div></div>
+        <div class="stat"><div class="num">{entrada_total}</div><div class="label">Tokens de entrada</div></div>
+        <div class="stat"><div class="num">{uso.get("saida", 0)}</div><div class="label">Tokens de saida</div></div>
+        <div class="stat"><div class="num">{pct_cache}%</div><div class="label">Entrada lida do cache</div></div>
+        <div class="stat"><div class="num">{uso.get("cache_escrita", 0)}</div><div class="label">Tokens gravados no cache</div></div>
+    </div>"""
+
+    rows_llm = ""
+    for modelo, latencias in latencias_llm.items():
+        rows_llm += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{modelo}</strong></div>
+                <div class="aluno-info">{uso.get(f"{modelo}:chamadas", 0)} chamadas hoje | cache {uso.get(f"{modelo}:cache_leitura", 0)} lidos / {uso.get(f"{modelo}:cache_escrita", 0)} gravados | p50 {percentil(latencias, 0.50):.1f} s | p95 {percentil(latencias, 0.95):.1f} s</div>
+            </div>
+        </div>"""
+    if not rows_llm:
+        rows_llm = "<p style='color:#888;padding:12px 0'>Nenhuma chamada desde o ultimo restart.</p>"
+
+    cache = await resumo_cache_midia()
+    rows_cache = ""
+    for tipo in ("audio", "pdf", "planilha"):
+        acertos = cache["contadores"].get(f"{tipo}:acertos", 0)
+        falhas  = cache["contadores"].get(f"{tipo}:falhas", 0)
+        taxa    = round(100 * acertos / (acertos + falhas), 1) if acertos + falhas else 0
+        rows_cache += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{tipo}</strong> <span class="badge badge-ativo">{taxa}% reaproveitado</span></div>
+                <div class="aluno-info">{acertos} acertos | {falhas} falhas</div>
+            </div>
+        </div>"""
+
+    respostas = await resumo_cache_respostas()
+
+    rows = ""
+    for m in resumo_metricas_http():
+        taxa_erro = round(100 * m["erros"] / m["requisicoes"], 1) if m["requisicoes"] else 0
+        badge = "badge-inativo" if taxa_erro >= 5 else "badge-ativo"
+        rows += f"""
+        <div class="aluno-row">
+            <div>
+                <div><strong>{m["servico"]}</strong> <span class="badge {badge}">{taxa_erro}% erros</span></div>
+                <div class="aluno-info">{m["requisicoes"]} requisicoes | {m["erros"]} erros | p50 {m["p50"] * 1000:.0f} ms | p95 {m["p95"] * 1000:.0f} ms</div>
+            </div>
+        </div>"""
+
+    conteudo = stats + f"""
+    <div class="card">
+        <h2>Modelos</h2>
+        {rows_llm}
+    </div>
+    <div class="card">
+        <h2>Cache de midia</h2>
+        <div class="total">{cache["entradas"]} transcricoes/leituras guardadas | {cache["bytes"] / 1024 / 1024:.1f} de {MIDIA_CACHE_MB:g} MB</div>
+        {rows_cache}
+    </div>
+    <div class="card">
+        <h2>Cache de respostas</h2>
+        <div class="total">{respostas["entradas"]} respostas guardadas | {"ligado" if RESPOSTAS_CACHE else "desligado (RESPOSTAS_CACHE=1 liga)"}</div>
+        <div class="aluno-row">
+            <div>
+                <div><strong>perguntas sem contexto</strong> <span class="badge badge-ativo">{respostas["taxa"]}% reaproveitado</span></div>
+                <div class="aluno-info">{respostas["acertos"]} acertos | {respostas["falhas"]} falhas</div>
+            </div>
+            <a href="/admin/cache" class="btn btn-primary">Ver respostas</a>
+        </div>
+    </div>
+    <div class="card">
+        <h2>Servicos externos</h2>
+        <div class="total">Desde o ultimo restart do servidor (latencia das ultimas 500 chamadas)</div>
+        {rows}
+    </div>"""
+
+    return HTMLResponse(base_html("Metricas", conteudo, "metricas"))
+
 # ============================================================
 # WEBHOOK Z-API (WhatsApp)
 # ============================================================
@@ -1062,21 +3522,49 @@ async def webhook(request: Request):
         if not telefone:
             return {"status": "ignorado"}
 
-        texto_midia = await processar_midia(dados)
-        if texto_midia:
-            resposta = await chamar_claude(telefone, texto_midia)
-            await enviar_whatsapp(telefone, resposta)
-            return {"status": "ok"}
-
-        texto = dados.get("text", {}).get("message", "")
-        if not texto:
+        tem_conteudo = dados.get("text", {}).get("message") or dados.get("audio") or dados.get("document")
+        if not tem_conteudo:
             return {"status": "ignorado"}
 
-        print(f"MSG de {telefone}: {texto[:80]}")
-        resposta = await chamar_claude(telefone, texto)
-        await enviar_whatsapp(telefone, resposta)
+        # Reentrega da mesma mensagem: descarta antes de gastar midia/Claude/envio
+        id_mensagem = dados.get("messageId")
+        if id_mensagem and not await evento_novo("zapi", id_mensagem):
+            return {"status": "duplicado"}
+
+        # Midia, Claude e envio rodam nos workers — Z-API recebe a resposta na hora
+        if fila_entrada.full():
+            await registrar_falha_fila({"telefone": telefone, "mensagens": [dados]}, "fila cheia")
+            return {"status": "erro", "detalhe": "fila cheia"}
+        await receber_mensagem(telefone, dados)
         return {"status": "ok"}
 
     except Exception as e:
         print(f"ERRO webhook: {e}")
         return {"status": "erro", "detalhe": str(e)}
+
+# ============================================================
+# COMANDOS DE MANUTENCAO — python main.py <comando>
+# ============================================================
+COMANDOS = {
+    "migrar-historico": migrar_historicos,
+    "reindexar":        reindexar,
+    "sincronizar-mp":   sincronizar_mp,
+}
+
+if __name__ == "__main__":
+    import sys
+    comando = sys.argv[1] if len(sys.argv) > 1 else ""
+    if comando not in COMANDOS:
+        print(f"Uso: python main.py <{' | '.join(COMANDOS)}>")
+        sys.exit(1)
+
+    async def rodar():
+        # Fora do lifespan do app: os clientes HTTP (ex: Mercado Pago) sao abertos aqui
+        abrir_clientes_http()
+        try:
+            await COMANDOS[comando]()
+        finally:
+            await fechar_clientes_http()
+            await r.aclose()
+
+    asyncio.run(rodar())